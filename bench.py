@@ -0,0 +1,311 @@
+#! /usr/bin/env python
+""" Headless benchmarks. Runs the game's update/render loop on scripted input
+as fast as it will go, using SDL's dummy video driver, and reports how long
+each phase of a frame took.
+
+    python bench.py                  # run everything, compare to the baseline
+    python bench.py --save           # record this machine's baseline
+    python bench.py timeflip -n 5000 # just one scenario, for longer
+    python bench.py --replay s.keys  # input recorded with main.py --record
+    python bench.py --trace t.json   # and save every frame as a Chrome trace
+
+Exits with status 1 if a phase got slower than the baseline allows, or if
+a scenario didn't go through the rooms it's meant to.
+"""
+
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import sys, json, hashlib, argparse
+from timeit import default_timer
+
+import pygame
+import main
+from replay import Replay
+from profiler import Profiler
+
+PHASES = ["events", "update", "render", "present"]
+PERCENTILES = [50, 90, 99]
+
+BASELINE_FILE = "bench_baseline.json"
+
+# Allowed slowdown before we call it a regression: relative, plus a little
+# absolute slack so phases that take microseconds don't trip on noise.
+TOLERANCE = 0.25
+SLACK_MS = 0.05
+
+class Script:
+  """ Scripted input: which keys go down and come up on which tick.
+
+  UpKeys only remembers the last key pressed in a tick, so taps should get a
+  tick to themselves. Within a tick, releases are sent before presses. """
+  def __init__(self, length):
+    self.length = length
+    self.keys = {}
+
+  def at(self, tick, kind, key):
+    self.keys.setdefault(tick, []).append((kind, key))
+    self.keys[tick].sort(key=lambda event: event[0] != pygame.KEYUP)
+    return self
+
+  def hold(self, start, end, key):
+    self.at(start, pygame.KEYDOWN, key)
+    return self.at(end, pygame.KEYUP, key)
+
+  def tap(self, tick, key):
+    return self.hold(tick, tick + 1, key)
+
+  def events(self, tick):
+    return [pygame.event.Event(kind, key=key) for kind, key in self.keys.get(tick, [])]
+
+class Scenario:
+  """ A Script to get somewhere, then another one to repeat forever. If it's
+  meant to go through rooms, rooms says how many it has to see, so a script
+  that stops lining up with the doors fails instead of benchmarking one
+  room. """
+  def __init__(self, name, doc, intro, loop, rooms=1):
+    self.name = name
+    self.doc = doc
+    self.intro = intro
+    self.loop = loop
+    self.rooms = rooms
+
+  def events(self, tick):
+    if tick < self.intro.length:
+      return self.intro.events(tick)
+    return self.loop.events((tick - self.intro.length) % self.loop.length)
+
+# All of these start where a DEBUG game does: in room (1, 0), in the future.
+
+def crossings():
+  # Right until we're in line with the door at the bottom of (1, 0), then
+  # down into (1, 1) and back up.
+  intro = Script(37).hold(0, 36, pygame.K_RIGHT)
+  loop = Script(200).hold(0, 100, pygame.K_DOWN).hold(100, 200, pygame.K_UP)
+
+  return Scenario("crossings", "walk back and forth through a door between rooms", intro, loop, rooms=2)
+
+def timeflip():
+  loop = Script(2).tap(0, pygame.K_SPACE)
+
+  return Scenario("timeflip", "SPACE as fast as the game will take it", Script(0), loop)
+
+def bullets():
+  loop = Script(120).hold(0, 119, pygame.K_z)
+  for tick, key in [(10, pygame.K_RIGHT), (40, pygame.K_DOWN), (70, pygame.K_LEFT), (100, pygame.K_UP)]:
+    loop.hold(tick, tick + 2, key)
+
+  return Scenario("bullets", "hold Z and turn around", Script(0), loop)
+
+def dialog():
+  # Flip to the present and walk up to Grandma.
+  intro = Script(301).tap(0, pygame.K_SPACE)
+  intro.hold(2, 12, pygame.K_DOWN).hold(12, 77, pygame.K_RIGHT)
+  for tick in range(90, 300, 15):
+    intro.tap(tick, pygame.K_x)
+
+  # When the present runs out, flip back and keep talking.
+  loop = Script(302).tap(0, pygame.K_SPACE)
+  for tick in range(15, 300, 15):
+    loop.tap(tick, pygame.K_x)
+
+  return Scenario("dialog", "keep talking to Grandma", intro, loop)
+
+SCENARIOS = [crossings, timeflip, bullets, dialog]
+
+class ReplayScenario:
+  """ Input recorded from a real session with main.py --record. """
+  def __init__(self, path):
+    self.replay = Replay(path)
+    self.name = "replay"
+    self.doc = path
+    self.rooms = 1
+
+  def events(self, tick):
+    return self.replay.events(tick)
+
+def snapshot(manager):
+  """ What the simulation looks like this tick, for telling runs apart. """
+  char = manager.one("character")
+  m = manager.one("map")
+
+  return "%s %s %s %s %s %d" % (char.x, char.y, m.cur_pos(), m.current_state(),
+                                char.inventory, len(manager.get("bullet")))
+
+def simulate(scenario, ticks, debug=True):
+  """ Run a fresh game on scenario's input for ticks frames. Returns the
+  seconds each phase took, per frame, a digest of every tick's state, the
+  game, and the rooms it went through. Like the main loop, sleep sequence
+  frames don't count as ticks. """
+  main.DEBUG = debug
+  manager = main.new_game()
+
+  times = dict((phase, []) for phase in PHASES)
+  digest = hashlib.md5()
+  rooms = set()
+
+  tick = 0
+  while tick < ticks:
+    if main.GameState.current_state == main.GameState.sleep_sequence:
+      main.sleep_sequence(manager)
+      continue
+
+    Profiler.start_frame()
+    start = default_timer()
+    Profiler.begin("events")
+    main.handle_events(scenario.events(tick))
+    Profiler.end()
+    after_events = default_timer()
+    Profiler.begin("update")
+    main.update_all(manager)
+    Profiler.end()
+    after_update = default_timer()
+    Profiler.begin("render")
+    dirty = main.render(manager)
+    Profiler.end()
+    after_render = default_timer()
+    Profiler.begin("present")
+    main.present(dirty)
+    Profiler.end()
+    after_present = default_timer()
+    Profiler.end_frame()
+
+    times["events"].append(after_events - start)
+    times["update"].append(after_update - after_events)
+    times["render"].append(after_render - after_update)
+    times["present"].append(after_present - after_render)
+
+    digest.update(snapshot(manager))
+    rooms.add(tuple(manager.one("map").cur_pos()))
+    tick += 1
+
+  return times, digest.hexdigest(), manager, rooms
+
+def percentile(values, p):
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+def summarize(times):
+  """ phase => {"p50": ms, ..., "max": ms} """
+  summary = {}
+
+  for phase in PHASES:
+    summary[phase] = dict(("p%d" % p, percentile(times[phase], p) * 1000) for p in PERCENTILES)
+    summary[phase]["max"] = max(times[phase]) * 1000
+
+  return summary
+
+def report_prefetch(manager):
+  """ How well rooms were built ahead of time, and every room load the
+  game had to wait for. """
+  prefetcher = manager.one("map").prefetcher
+
+  print "  prefetch: %.0f%% hits (%d ready, %d waited on, %d not prefetched)" %\
+    (prefetcher.hit_rate() * 100, prefetcher.hits, prefetcher.waits, prefetcher.misses)
+  for (map_name, x, y), seconds in prefetcher.stalls:
+    print "  blocked %.3fms on %s (%d, %d)" % (seconds * 1000, map_name, x, y)
+
+def report_memory():
+  """ What the sprite sheets hold on to. """
+  for name, (size, tiles) in sorted(main.TileSheet.memory().items()):
+    print "  sheet %-10s %6d KB, %d tiles cut out" % (name, size / 1024, tiles)
+
+def regressions(name, summary, baseline, tolerance):
+  found = []
+
+  for phase in PHASES:
+    for stat in ["p50", "p90"]:
+      was = baseline[phase][stat]
+      now = summary[phase][stat]
+      if now > was * (1 + tolerance) + SLACK_MS:
+        found.append("%s %s %s: %.3fms, baseline %.3fms" % (name, phase, stat, now, was))
+
+  return found
+
+def report(name, summary):
+  for phase in PHASES:
+    stats = summary[phase]
+    print "%-10s %-8s" % (name, phase),
+    print " ".join("%8.3f" % stats["p%d" % p] for p in PERCENTILES), "%8.3f" % stats["max"]
+
+def run(args):
+  main.DIRTY_RECTS = args.dirty
+
+  chosen = [s() for s in SCENARIOS]
+  if args.scenarios:
+    chosen = [s for s in chosen if s.name in args.scenarios]
+
+  baseline = {}
+  if os.path.exists(args.baseline):
+    baseline = json.load(open(args.baseline))
+
+  results = {}
+  failures = []
+  broken = [] # Scenarios that didn't go where they should.
+
+  print "%-10s %-8s" % ("scenario", "phase"),
+  print " ".join("%8s" % ("p%d" % p) for p in PERCENTILES), "%8s" % "max", "(ms)"
+
+  runs = [(scenario, args.ticks, True) for scenario in chosen]
+  if args.replay:
+    recorded = ReplayScenario(args.replay)
+    runs = [(recorded, recorded.replay.ticks, recorded.replay.debug)]
+
+  for scenario, ticks, debug in runs:
+    if args.trace:
+      Profiler.start_trace(scenario.name)
+    times, digest, manager, rooms = simulate(scenario, ticks, debug)
+    Profiler.stop_trace()
+    summary = summarize(times)
+    report(scenario.name, summary)
+    if args.prefetch:
+      report_prefetch(manager)
+    if len(rooms) < scenario.rooms:
+      broken.append("%s went through %d room(s), it's meant to see %d" % (scenario.name, len(rooms), scenario.rooms))
+
+    key = "%s/%d%s" % (scenario.name, ticks, "/dirty" if args.dirty else "")
+    if args.replay:
+      key = "%s/%s" % (key, os.path.basename(args.replay))
+    results[key] = {"digest": digest, "phases": summary}
+
+    if key in baseline and not args.save:
+      if baseline[key]["digest"] != digest:
+        print "  note: %s plays out differently than in the baseline" % scenario.name
+      failures += regressions(scenario.name, summary, baseline[key]["phases"], args.tolerance)
+
+  if args.save:
+    baseline.update(results)
+    json.dump(baseline, open(args.baseline, "w"), indent=2, sort_keys=True)
+    print "Saved baseline to", args.baseline
+  elif not baseline:
+    print "No baseline at %s, run with --save to record one." % args.baseline
+
+  if args.memory:
+    report_memory()
+
+  if args.trace:
+    Profiler.save(args.trace)
+    print "Saved a trace of every frame to", args.trace
+
+  for failure in failures:
+    print "REGRESSION", failure
+  for failure in broken:
+    print "BROKEN", failure
+
+  return 1 if failures or broken else 0
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Headless frame time benchmarks.")
+  parser.add_argument("scenarios", nargs="*", help="which to run: " + ", ".join(s.__name__ for s in SCENARIOS))
+  parser.add_argument("-n", "--ticks", type=int, default=1200, help="frames per scenario")
+  parser.add_argument("--replay", metavar="FILE", help="run input recorded with main.py --record instead")
+  parser.add_argument("--dirty", action="store_true", help="use the dirty rectangle renderer")
+  parser.add_argument("--prefetch", action="store_true", help="report how room prefetching went")
+  parser.add_argument("--memory", action="store_true", help="report what the sprite sheets take up")
+  parser.add_argument("--trace", metavar="FILE", help="profile every frame and save them to FILE as Chrome trace events")
+  parser.add_argument("--save", action="store_true", help="record the results as the new baseline")
+  parser.add_argument("--baseline", default=BASELINE_FILE)
+  parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="allowed relative slowdown")
+
+  sys.exit(run(parser.parse_args()))
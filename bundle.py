@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+""" Precompiled assets. Decoding the bmps and classifying every room's pixels
+happens once, here, instead of every time the game starts:
+
+    python bundle.py        # writes assets.bundle
+
+The game uses the bundle if it's newer than everything it was made from,
+and quietly goes back to the original files if not.
+
+A bundle is a header, a table of sections, then the sections:
+
+    header   "LD22PACK", version (uint16), number of sections (uint16)
+    section  name (32 bytes), offset (uint32), length (uint32)
+
+    sheet:<file>  width, height (uint16 each), then raw RGB pixels
+    rooms:<file>  rooms across, rooms down (uint16 each), then each room's
+                  tile kinds, one byte per tile. Rooms and tiles both go
+                  row by row.
+    dialog        the dialog script, parsed by dialog.parse and marshalled
+
+Everything is little endian. It's read through mmap, so nothing is loaded
+until it's used.
+"""
+
+import os
+import mmap
+import struct
+import marshal
+import dialog
+
+MAGIC = "LD22PACK"
+VERSION = 2 # 2: the dialog section is dialog.load(), not the old raw tables.
+
+HEADER = struct.Struct("<8sHH")
+SECTION = struct.Struct("<32sII")
+SIZE = struct.Struct("<HH")
+
+BUNDLE_FILE = "assets.bundle"
+
+# Where everything in the bundle comes from. How room tiles are classified
+# lives in main.py.
+SHEETS = ["tiles.bmp"]
+MAPS = ["map.bmp", "map2.bmp"]
+SOURCES = SHEETS + MAPS + [dialog.DIALOG_FILE, "dialog.py", "main.py"]
+
+class BundleException(Exception):
+  pass
+
+def is_current(path=BUNDLE_FILE, sources=SOURCES):
+  """ Does path exist and is it newer than everything it was made from? """
+  if not os.path.exists(path):
+    return False
+
+  made = os.path.getmtime(path)
+  return all(os.path.getmtime(source) <= made for source in sources if os.path.exists(source))
+
+class Bundle:
+  def __init__(self, path=BUNDLE_FILE):
+    self.file = open(path, "rb")
+    self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if len(self.data) < HEADER.size:
+      raise BundleException(path + " is too short to be a bundle.")
+
+    magic, version, count = HEADER.unpack_from(self.data)
+    if magic != MAGIC:
+      raise BundleException(path + " is not a bundle.")
+    if version != VERSION:
+      raise BundleException("%s is bundle version %d, we read %d." % (path, version, VERSION))
+
+    # name => (offset, length)
+    self.sections = {}
+    for i in range(count):
+      name, offset, length = SECTION.unpack_from(self.data, HEADER.size + i * SECTION.size)
+      self.sections[name.rstrip("\0")] = (offset, length)
+
+    self.grids = {}
+
+  def section(self, name):
+    """ A read only view of a section, or None if there's no such thing. """
+    if name not in self.sections:
+      return None
+
+    offset, length = self.sections[name]
+    return buffer(self.data, offset, length)
+
+  def sheet(self, file_name):
+    """ file_name's pixels as ((width, height), RGB buffer), or None. """
+    data = self.section("sheet:" + file_name)
+    if data is None:
+      return None
+
+    return SIZE.unpack_from(data), buffer(data, SIZE.size)
+
+  def room_grid(self, file_name):
+    """ How many rooms across and down file_name is, or None. """
+    if file_name not in self.grids:
+      data = self.section("rooms:" + file_name)
+      self.grids[file_name] = None if data is None else SIZE.unpack_from(data)
+
+    return self.grids[file_name]
+
+  def room(self, file_name, map_x, map_y, tiles):
+    """ Room (map_x, map_y)'s kinds, as decode_room would give them. """
+    across, down = self.room_grid(file_name)
+    if not (0 <= map_x < across and 0 <= map_y < down):
+      raise BundleException("room (%d, %d) is outside %s, which is %dx%d rooms" % (map_x, map_y, file_name, across, down))
+
+    offset = SIZE.size + (map_y * across + map_x) * tiles
+
+    return bytearray(self.section("rooms:" + file_name)[offset:offset + tiles])
+
+  def dialog(self):
+    data = self.section("dialog")
+    if data is None:
+      return None
+
+    return marshal.loads(data[:])
+
+  def close(self):
+    self.data.close()
+    self.file.close()
+
+def compile_bundle(path=BUNDLE_FILE):
+  """ Decode everything the hard way and write it all to path. """
+  import pygame
+  import main
+
+  sections = []
+
+  for file_name in SHEETS:
+    image = pygame.image.load(file_name)
+    sections.append(("sheet:" + file_name, SIZE.pack(*image.get_size()) + pygame.image.tostring(image, "RGB")))
+
+  room_size = main.TILE_SIZE
+  for file_name in MAPS:
+    image = pygame.image.load(file_name)
+    across, down = image.get_width() / room_size, image.get_height() / room_size
+
+    rooms = [SIZE.pack(across, down)]
+    for map_y in range(down):
+      for map_x in range(across):
+        room = image.subsurface((map_x * room_size, map_y * room_size, room_size, room_size))
+        rooms.append(str(main.decode_room(room)))
+
+    sections.append(("rooms:" + file_name, "".join(rooms)))
+
+  sections.append(("dialog", marshal.dumps(dialog.load())))
+
+  out = open(path, "wb")
+  out.write(HEADER.pack(MAGIC, VERSION, len(sections)))
+
+  offset = HEADER.size + SECTION.size * len(sections)
+  for name, data in sections:
+    out.write(SECTION.pack(name, offset, len(data)))
+    offset += len(data)
+
+  for name, data in sections:
+    out.write(data)
+
+  out.close()
+  return sections
+
+if __name__ == "__main__":
+  os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+  for name, data in compile_bundle():
+    print "%-16s %7d bytes" % (name, len(data))
+  print "Wrote", BUNDLE_FILE
@@ -0,0 +1,126 @@
+""" Dialog scripts. Everything anyone says lives in dialog.txt, which gets
+compiled once into conversations: lists of nodes that TalkToMe steps
+through one at a time.
+
+A script is a series of conversations, each a header and then one line per
+step:
+
+    = <map x> <map y> [future | has <item>]
+    Something to say.
+    !GET <item>
+    !DESTROY
+    !ADVANCESTATE
+
+A plain header is for the present. "future" is for the future, and
+"has <item>" trumps both once the player is carrying item. Lines starting
+with ! are commands, anything else is said as is. Blank lines and lines
+starting with # are skipped.
+"""
+
+from collections import namedtuple
+
+DIALOG_FILE = "dialog.txt"
+
+# Node kinds.
+SAY, GET, DESTROY, ADVANCESTATE = range(4)
+
+COMMANDS = {"GET": GET, "DESTROY": DESTROY, "ADVANCESTATE": ADVANCESTATE}
+
+# What a command takes: GET needs an item, the others nothing.
+ARGUMENTS = {GET: 1, DESTROY: 0, ADVANCESTATE: 0}
+
+# text is what SAY says or what GET gets. lines is text wrapped to fit the
+# text box, for SAY.
+Node = namedtuple("Node", "kind text lines")
+
+class DialogException(Exception):
+  pass
+
+def parse(source, name=DIALOG_FILE):
+  """ A script's conversations, as [(header, [(kind, text)])]. The header
+  is (map x, map y, condition), and condition is None, "future" or
+  ("has", item). This is the part the asset bundle stores. """
+  conversations = []
+
+  for number, line in enumerate(source.splitlines(), 1):
+    line = line.rstrip("\r\n")
+    where = "%s:%d: " % (name, number)
+
+    if not line.strip() or line.startswith("#"):
+      continue
+
+    if line.startswith("="):
+      conversations.append((parse_header(line[1:].split(), where), []))
+      continue
+
+    if not conversations:
+      raise DialogException(where + "a line before the first = header.")
+
+    if line.startswith("!"):
+      words = line[1:].split()
+      if not words or words[0] not in COMMANDS:
+        raise DialogException(where + "unknown command " + line)
+
+      kind = COMMANDS[words[0]]
+      if len(words) - 1 != ARGUMENTS[kind]:
+        raise DialogException(where + "%s takes %d argument(s)." % (words[0], ARGUMENTS[kind]))
+
+      conversations[-1][1].append((kind, " ".join(words[1:])))
+    else:
+      conversations[-1][1].append((SAY, line))
+
+  return conversations
+
+def parse_header(words, where):
+  try:
+    map_x, map_y = int(words[0]), int(words[1])
+  except (IndexError, ValueError):
+    raise DialogException(where + "a header starts with the room's map x and y.")
+
+  if len(words) == 2:
+    return (map_x, map_y, None)
+  if words[2:] == ["future"]:
+    return (map_x, map_y, "future")
+  if len(words) == 4 and words[2] == "has":
+    return (map_x, map_y, ("has", words[3]))
+
+  raise DialogException(where + "don't know when to use " + " ".join(words))
+
+class Room:
+  """ Who says what in one room: one conversation for each timeline, and
+  the ones that trump them when the player has something. """
+  def __init__(self):
+    self.timelines = {}
+    self.items = []
+
+  def conversation(self, who, timeline):
+    for item, nodes in self.items:
+      if item in who.inventory:
+        return nodes
+
+    # Nothing written for the future just means the same as the present.
+    return self.timelines.get(timeline) or self.timelines["present"]
+
+class Script:
+  """ Compiled conversations, indexed by room. wrap(text) splits a line to
+  fit the text box; it's called once per line, here. """
+  def __init__(self, conversations, wrap=None):
+    self.rooms = {}
+
+    for (map_x, map_y, condition), steps in conversations:
+      nodes = [Node(kind, text, wrap(text) if wrap and kind == SAY else None) for kind, text in steps]
+      nodes.append(Node(SAY, "", [""])) # The end, which puts the text box away.
+
+      room = self.rooms.setdefault((map_x, map_y), Room())
+      if condition is None:
+        room.timelines["present"] = nodes
+      elif condition == "future":
+        room.timelines["future"] = nodes
+      else:
+        room.items.append((condition[1], nodes))
+
+  def conversation(self, who, timeline, map_x, map_y):
+    return self.rooms[(map_x, map_y)].conversation(who, timeline)
+
+def load(path=DIALOG_FILE):
+  return parse(open(path).read(), path)
@@ -1,84 +1,163 @@
-import sys, pygame, spritesheet
-from wordwrap import render_textrect
+from timeit import default_timer
+started = default_timer() # Everything counts toward startup time.
+
+import sys, time, bisect, argparse, itertools, threading, pygame, spritesheet
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from wordwrap import render_textrect, render_lines, wrap_lines
+from replay import Recorder, Replay
+from profiler import Profiler
+import bundle, dialog
+
+try:
+  import numpy
+except ImportError: # Everything works without it, just slower.
+  numpy = None
 
 WIDTH = HEIGHT = 500
 TILE_SIZE = 20
 
 DEBUG = True
 
+# Only redraw and present the parts of the screen that changed.
+DIRTY_RECTS = False
+
 PRESENT = 0
 FUTURE = 1
 
 TICKS_PER_SEC = 60
 TIME_IN_FUTURE = 5
 
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
+# When the game falls behind real time, the most ticks it runs back to back
+# to catch up (past that, game time slows down instead), and the most frames
+# in a row it skips drawing to make time for them.
+MAX_CATCH_UP = 5
+MAX_FRAME_SKIP = 5
 
-def get_uid():
-  get_uid.uid += 1
-  return get_uid.uid
+# How many decoded rooms (of either map) we hold on to.
+ROOM_CACHE_SIZE = 16
+
+# How many rendered text boxes we hold on to.
+TEXT_CACHE_SIZE = 64
+
+# How close to the edge of a room the character gets before we start
+# building the room on the other side.
+PREFETCH_MARGIN = TILE_SIZE * 4
 
-get_uid.uid = 0
+# Shows and hides the profiler's numbers.
+OVERLAY_KEY = pygame.K_F3
+OVERLAY_FONT = ("nokiafc22.ttf", 8)
+
+class Startup:
+  """ Where the time to the first frame goes. Setup that happens on first
+  use times itself with timing() (or begin() and end()), and main() reports
+  the lot once the first frame is up. Time spent in a nested timing only
+  counts for the inner one. """
+  costs = OrderedDict()
+  running = [] # [what, started, time spent in nested timings]
+  done = False
 
-class DialogData:
   @staticmethod
-  def all_data():
-    d_dict={ (0, 0) : [ "You're looking pretty tired there, Ben."
-                      , "Before you go to sleep, "
-                      , "can you get some of Grandma's special"
-                      , "flipped apple pie?"
-                      , "Her house is really close."
-                      , "Just follow the path outside of the house."
-                      , "Why do you look scared?"
-                      ],
-             (0,0,"pie") : [ "Ah, the pie! Thanks, Ben!"
-                          , "Try a slice."
-                          , "SPECIAL It tastes a little funny..."
-                          , "SPECIAL but you don't say anything."
-                          , "Well, time for bed. Tomorrow's another big day!"
-                          , "ADVANCESTATE"
-                          ],
-             (1, 1) : [ "You hear a sound, far off... like a cry"], #TODO
-             (1, 0) : [ "Here's my special flipped apple pie!"
-                      , "GET FlippedApplePie"
-                      , "SPECIAL She hands the pie."
-                      , "Enjoy!"
-                      ],
-             (1, 0, True) : [ "OOH!"
-                            , "You find a Traveller in the box"
-                            , "GET Traveller"
-                            , "along with a note."
-                            , "To those who should find themselves alone..."
-                            , "Press SPACE."
-                            , "You will flip back to your normal time.."
-                            , "for 5 seconds."
-                            , "Sorry, it's the best we could do."
-                            , "DESTROY"
-                            ]
-           }
-
-    if not hasattr(DialogData, 'data'):
-      actual = {}
-      for tpl in d_dict:
-        actual[tpl] = d_dict[tpl]
-        actual[tpl].append("") #end of dialog
-
-      DialogData.data = actual
-
-    return DialogData.data
+  def begin(what):
+    Startup.running.append([what, default_timer(), 0.0])
 
   @staticmethod
-  def get_data(who, state, map_x, map_y):
+  def end():
+    what, start, inner = Startup.running.pop()
+    spent = default_timer() - start
+    if Startup.running:
+      Startup.running[-1][2] += spent
 
-    if GameState.state == "future":
-      d_list = DialogData.all_data()[(map_x, map_y, True)]
-    else:
-      d_list = DialogData.all_data()[(map_x, map_y)]
+    Startup.add(what, spent - inner)
 
-    if map_x == 0 and map_y == 0 and who.has_apple_pie():
-      d_list = DialogData.all_data()[(map_x, map_y, "pie")]
-      
-    return d_list[state % len(d_list)]
+  @staticmethod
+  @contextmanager
+  def timing(what):
+    Startup.begin(what)
+    try:
+      yield
+    finally:
+      Startup.end()
+
+  @staticmethod
+  def add(what, seconds):
+    if not Startup.done:
+      Startup.costs[what] = Startup.costs.get(what, 0.0) + seconds
+
+  @staticmethod
+  def report():
+    """ Stop counting and print the breakdown. """
+    Startup.done = True
+    total = default_timer() - started
+    other = total - sum(Startup.costs.values())
+
+    parts = ["%s %.1fms" % (what, spent * 1000) for what, spent in Startup.costs.items()]
+    print "First frame after %.1fms: %s, other %.1fms" % (total * 1000, ", ".join(parts), other * 1000)
+
+class Display:
+  """ The window, opened the first time something needs it, either to draw
+  or to convert images to its pixel format. Just importing main doesn't. """
+  screen = None
+
+  @staticmethod
+  def get():
+    if Display.screen is None:
+      with Startup.timing("display"):
+        pygame.display.init()
+        Display.screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    return Display.screen
+
+class Music:
+  """ The mixer only gets started if something actually plays. """
+  @staticmethod
+  def play(file_name, loops=-1):
+    if not pygame.mixer.get_init():
+      with Startup.timing("mixer"):
+        pygame.mixer.init(frequency=22050, size=-16, channels=2, buffer=1024)
+
+    pygame.mixer.music.load(file_name)
+    pygame.mixer.music.play(loops)
+
+# Rooms get built on another thread too, so no += here.
+def get_uid():
+  return next(get_uid.uids)
+
+get_uid.uids = itertools.count(1)
+
+class Assets:
+  """ The precompiled bundle (see bundle.py), opened the first time anyone
+  asks for it, if it's up to date. None means load from the original files
+  instead. """
+  checked = False
+  bundle = None
+
+  @staticmethod
+  def get():
+    if not Assets.checked:
+      Assets.checked = True
+      if bundle.is_current():
+        try:
+          Assets.bundle = bundle.Bundle()
+        except bundle.BundleException as e:
+          print e, "Using the original files."
+    return Assets.bundle
+
+class Dialog:
+  """ The compiled dialog script (see dialog.py), loaded the first time
+  anyone talks. """
+  script = None
+
+  @staticmethod
+  def get():
+    if Dialog.script is None:
+      assets = Assets.get()
+      conversations = assets.dialog() if assets is not None else None
+      if conversations is None:
+        conversations = dialog.load()
+
+      Dialog.script = dialog.Script(conversations, Text.wrap)
+    return Dialog.script
 
 class Rect:
   def __init__(self, x, y, w, h):
@@ -102,56 +181,395 @@ class Point:
   def __str__(self):
     return "<Point x : %f y : %f>" % (self.x, self.y)
 
+class LRUCache:
+  """ A dict that forgets its least recently used entries once it holds more
+  than max_size of them. Counts hits and misses so we can see if it helps. """
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.items = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def __contains__(self, key):
+    return key in self.items
+
+  def get(self, key):
+    if key not in self.items:
+      self.misses += 1
+      return None
+
+    self.hits += 1
+    value = self.items.pop(key)
+    self.items[key] = value
+    return value
+
+  def put(self, key, value):
+    self.items.pop(key, None)
+    self.items[key] = value
+
+    while len(self.items) > self.max_size:
+      self.items.popitem(last=False)
+
+class Prefetcher:
+  """ Builds things on a worker thread before they're asked for. want(key,
+  *args) queues build(*key + args), take(key) hands over the result, waiting
+  for it if it's still being built. The worker only runs while there's work
+  queued. Whatever build needs from the main thread should come in args, as
+  a copy, so the worker never reads state that's changing under it.
+
+  Counts how take() went: hits were ready, waits had to block on the
+  worker, misses were never wanted. Every take() that blocked, and for how
+  long, ends up in stalls. """
+  def __init__(self, build, max_ready=ROOM_CACHE_SIZE):
+    self.build = build
+    self.max_ready = max_ready
+    self.queue = deque()
+    self.pending = set()
+    self.ready = OrderedDict()
+    self.lock = threading.Condition()
+    self.thread = None
+
+    self.hits = 0
+    self.waits = 0
+    self.misses = 0
+    self.stalls = []
+
+  def want(self, key, *args):
+    with self.lock:
+      if key in self.pending or key in self.ready:
+        return
+
+      self.pending.add(key)
+      self.queue.append((key, args))
+
+      if self.thread is None:
+        # Not a daemon: it's never long, and dying mid-build at exit is messy.
+        self.thread = threading.Thread(target=self.work)
+        self.thread.start()
+
+  def work(self):
+    while True:
+      with self.lock:
+        if not self.queue:
+          self.thread = None
+          return
+        key, args = self.queue.popleft()
+
+      try:
+        result = (self.build(*(key + args)), None)
+      except Exception, e:
+        result = (None, e)
+
+      with self.lock:
+        self.pending.discard(key)
+        self.ready[key] = result
+        while len(self.ready) > self.max_ready:
+          self.ready.popitem(last=False)
+        self.lock.notify_all()
+
+  def take(self, key):
+    """ The result of build(*key), or None if it was never wanted. """
+    with self.lock:
+      if key in self.ready:
+        self.hits += 1
+      elif key in self.pending:
+        self.waits += 1
+        start = default_timer()
+        while key not in self.ready:
+          self.lock.wait()
+        self.stalls.append((key, default_timer() - start))
+      else:
+        self.misses += 1
+        return None
+
+      result, error = self.ready.pop(key)
+
+    if error is not None:
+      raise error
+    return result
+
+  def hit_rate(self):
+    total = self.hits + self.waits + self.misses
+    return float(self.hits) / total if total else 0.0
+
 class TileSheet:
   """ Memoize all the sheets so we don't load in 1 sheet like 50 times and 
   squander resources. This is a singleton, which is generally frowned upon, 
   but I think it's okay here."""
   sheets = {}
 
+  # file name => {(x, y): tile}. Tiles are cut out the first time they're
+  # asked for, as views of the sheet, so they don't cost any pixels.
+  tiles = {}
+
   @staticmethod
   def add(file_name):
     if file_name in TileSheet.sheets:
       return
 
-    new_sheet = spritesheet.spritesheet(file_name)
-    width, height = dimensions = new_sheet.sheet.get_size()
-    TileSheet.sheets[file_name] =\
-     [[new_sheet.image_at((x, y, TILE_SIZE, TILE_SIZE), colorkey=(255,255,255))\
-       for y in range(0, height, TILE_SIZE)] for x in range(0, width, TILE_SIZE)]
+    Display.get() # Sheets get converted to the screen's format.
+
+    with Startup.timing("sheets"):
+      assets = Assets.get()
+      pixels = assets.sheet(file_name) if assets is not None else None
+
+      if pixels is None:
+        TileSheet.sheets[file_name] = spritesheet.spritesheet(file_name)
+      else:
+        size, rgb = pixels
+        TileSheet.sheets[file_name] = spritesheet.spritesheet(file_name, pygame.image.frombuffer(rgb, size, "RGB"))
+      TileSheet.tiles[file_name] = {}
 
   @staticmethod
   def get(sheet, x, y):
     if sheet not in TileSheet.sheets:
       TileSheet.add(sheet)
-    return TileSheet.sheets[sheet][x][y]
+
+    tiles = TileSheet.tiles[sheet]
+    if (x, y) not in tiles:
+      width, height = TileSheet.size(sheet)
+      if not (0 <= x < width and 0 <= y < height):
+        raise IndexError("tile (%d, %d) is outside %s, which is %dx%d tiles" % (x, y, sheet, width, height))
+
+      tiles[(x, y)] = TileSheet.sheets[sheet].view_at(\
+        (x * TILE_SIZE, y * TILE_SIZE, TILE_SIZE, TILE_SIZE), colorkey=(255,255,255))
+    return tiles[(x, y)]
+
+  @staticmethod
+  def size(sheet):
+    """ How many tiles across and down sheet is. """
+    if sheet not in TileSheet.sheets:
+      TileSheet.add(sheet)
+
+    width, height = TileSheet.sheets[sheet].sheet.get_size()
+    return (width / TILE_SIZE, height / TILE_SIZE)
+
+  @staticmethod
+  def memory():
+    """ file name => (bytes of pixels, tiles cut out so far). Only the sheets
+    themselves hold pixels. """
+    usage = {}
+
+    for name, sheet in TileSheet.sheets.items():
+      surface = sheet.sheet
+      usage[name] = (surface.get_pitch() * surface.get_height(), len(TileSheet.tiles[name]))
+
+    return usage
+
+class Fonts:
+  """ Same deal as TileSheet, but for fonts: each (file, size) is loaded from
+  disk once. Rendered text is memoized too, since most text boxes show the
+  same string frame after frame. """
+  fonts = {}
+  rendered = LRUCache(TEXT_CACHE_SIZE)
+
+  @staticmethod
+  def get(file_name, size):
+    if (file_name, size) not in Fonts.fonts:
+      with Startup.timing("fonts"):
+        if not pygame.font.get_init():
+          pygame.font.init()
+        Fonts.fonts[(file_name, size)] = pygame.font.Font(file_name, size)
+    return Fonts.fonts[(file_name, size)]
+
+  @staticmethod
+  def render_textrect(string, font, rect, text_color, background_color, fuzzy=False, justification=0):
+    """ render_textrect, but font is a (file, size) pair and the surface we
+    return is shared, so don't draw on it. """
+    key = (string, font, (rect.w, rect.h), text_color, background_color, fuzzy, justification)
+    surface = Fonts.rendered.get(key)
+
+    if surface is None:
+      with Profiler.timing("render_textrect"):
+        surface = render_textrect(string, Fonts.get(*font), rect, text_color, background_color, fuzzy, justification)
+      Fonts.rendered.put(key, surface)
+
+    return surface
+
+  @staticmethod
+  def render_lines(lines, font, rect, text_color, background_color, fuzzy=False, justification=0):
+    """ Same, for text that's already been split into lines. """
+    key = (tuple(lines), font, (rect.w, rect.h), text_color, background_color, fuzzy, justification)
+    surface = Fonts.rendered.get(key)
+
+    if surface is None:
+      with Profiler.timing("render_textrect"):
+        surface = render_lines(lines, Fonts.get(*font), rect, text_color, background_color, fuzzy, justification)
+      Fonts.rendered.put(key, surface)
+
+    return surface
 
 def rect_touchpoint(rect, point):
     return rect.x <= point.x <= rect.x + rect.size and\
            rect.y <= point.y <= rect.y + rect.size
 
+# Both of these test the corners of one rect against the other, edges
+# inclusive. A corner is inside iff its x and its y both are, so we check the
+# two x's and the two y's instead of building four Points.
+
+def merge_rects(rects):
+  """ Union overlapping pygame Rects until none of them overlap. """
+  merged = []
+
+  for rect in rects:
+    rect = pygame.Rect(rect)
+    i = rect.collidelist(merged)
+    while i != -1:
+      rect.union_ip(merged.pop(i))
+      i = rect.collidelist(merged)
+    merged.append(rect)
+
+  return merged
+
 def rect_intersect(rect1, rect2):
-  corners = [ Point(rect1.x, rect1.y)\
-            , Point(rect1.x + rect1.size, rect1.y)\
-            , Point(rect1.x, rect1.y + rect1.size)\
-            , Point(rect1.x + rect1.size, rect1.y + rect1.size)]
+  left, top = rect2.x, rect2.y
+  right, bottom = left + rect2.size, top + rect2.size
+
+  x, y, size = rect1.x, rect1.y, rect1.size
 
-  for p in corners:
-    if rect_touchpoint(rect2, p):
-      return True
-  return False
+  return (left <= x <= right or left <= x + size <= right) and\
+         (top <= y <= bottom or top <= y + size <= bottom)
 
 def rect_contains(big, small):
-  corners = [ Point(small.x, small.y)\
-            , Point(small.x + small.size, small.y)\
-            , Point(small.x, small.y + small.size)\
-            , Point(small.x + small.size, small.y + small.size)]
+  left, top = big.x, big.y
+  right, bottom = left + big.size, top + big.size
 
-  for p in corners:
-    if not rect_touchpoint(big, p):
-      return False
-  return True
+  x, y, size = small.x, small.y, small.size
+
+  return left <= x <= right and left <= x + size <= right and\
+         top <= y <= bottom and top <= y + size <= bottom
+
+class Groups:
+  """ Group names, interned as bits. An entity's groups are one int, its
+  mask, so testing for several groups at once is one & instead of a lookup
+  each. """
+  bits = {}
+  names = []
+  masks = {} # mask => the names in it, since the same few come up a lot.
+
+  # Rooms, and what's in them, get built on the prefetch thread too.
+  lock = threading.Lock()
+
+  @staticmethod
+  def bit(name):
+    if name not in Groups.bits:
+      with Groups.lock:
+        if name not in Groups.bits:
+          Groups.names.append(name)
+          Groups.bits[name] = 1 << (len(Groups.names) - 1)
+    return Groups.bits[name]
+
+  @staticmethod
+  def mask(names):
+    mask = 0
+    for name in names:
+      mask |= Groups.bit(name)
+    return mask
+
+  @staticmethod
+  def names_in(mask):
+    if mask not in Groups.masks:
+      Groups.masks[mask] = tuple(name for name in Groups.names if mask & Groups.bits[name])
+    return Groups.masks[mask]
+
+# Entities removed during the update loop are in this group until the end of
+# it, which keeps them out of every query.
+REMOVED = Groups.bit("removed")
+
+class SpatialHash:
+  """ Files entities under every CELL_SIZE cell their box touches, so "what
+  overlaps this rect" only looks at entities nearby. Entities that move must
+  be re-filed through move(). """
+  CELL_SIZE = TILE_SIZE * 2
+
+  def __init__(self):
+    self.cells = {}
+    self.placed = {}
+
+  def cell_range(self, rect):
+    c = SpatialHash.CELL_SIZE
+    return (int(rect.x // c), int(rect.y // c),\
+            int((rect.x + rect.size) // c), int((rect.y + rect.size) // c))
+
+  def insert(self, entity):
+    x0, y0, x1, y1 = self.placed[entity] = self.cell_range(entity)
+
+    for cx in range(x0, x1 + 1):
+      for cy in range(y0, y1 + 1):
+        if (cx, cy) not in self.cells:
+          self.cells[(cx, cy)] = OrderedDict()
+        self.cells[(cx, cy)][entity] = True
+
+  def remove(self, entity):
+    if entity not in self.placed:
+      return
+
+    x0, y0, x1, y1 = self.placed.pop(entity)
+
+    for cx in range(x0, x1 + 1):
+      for cy in range(y0, y1 + 1):
+        del self.cells[(cx, cy)][entity]
+
+  def move(self, entity):
+    if self.placed.get(entity) == self.cell_range(entity):
+      return
+
+    self.remove(entity)
+    self.insert(entity)
+
+  def near(self, rect):
+    """ Everything sharing a cell with rect. This is a superset of what
+    touches rect, since touching rects always share a point. """
+    x0, y0, x1, y1 = self.cell_range(rect)
+
+    if x0 == x1 and y0 == y1:
+      return list(self.cells.get((x0, y0), ()))
+
+    results = []
+    seen = set()
+    for cx in range(x0, x1 + 1):
+      for cy in range(y0, y1 + 1):
+        for e in self.cells.get((cx, cy), ()):
+          if e not in seen:
+            seen.add(e)
+            results.append(e)
+
+    return results
+
+class Placed(object):
+  """ Something with a place, a size and groups: what queries find. Entity
+  builds on it, and so does Tile, which keeps all of that in its table. """
+  __slots__ = []
+
+  # Whether this has a meaningful position for overlap queries.
+  spatial = True
+
+  def touches_point(self, point):
+    return self.x <= point.x <= self.x + self.size and\
+           self.y <= point.y <= self.y + self.size
+  
+  def touches_rect(self, other):
+    if hasattr(self, 'uid') and hasattr(other, 'uid') and self.uid == other.uid: 
+       return False
+    return rect_intersect(self, other)
+
+  @property
+  def groups(self):
+    return Groups.names_in(self.mask)
+
+  def has(self, group):
+    return self.mask & Groups.bit(group) != 0
+
+  # How high/low this object is
+  def depth(self):
+    return 0
+
+class Entity(Placed):
+  # Subclasses that don't list their own slots still get a __dict__, this
+  # just lets the ones that do (like Bullet) go without.
+  __slots__ = ["x", "y", "size", "flicker", "src_file", "img", "uid",
+               "events", "mask", "manager", "slot", "alarm"]
 
-class Entity(object):
   def __init__(self, x, y, groups, src_x = -1, src_y = -1, src_file = ""):
     self.x = x
     self.y = y
@@ -163,89 +581,218 @@ class Entity(object):
       self.set_img(src_x, src_y)
      
     self.uid = get_uid()
-    self.events = {}
-    self.groups = groups
+    self.events = None # Made on demand, hardly anything listens.
+    self.mask = Groups.mask(groups)
+    self.manager = None
+    self.slot = None
+    self.alarm = None
 
   def set_img(self, src_x, src_y):
     self.img = TileSheet.get(self.src_file, src_x, src_y)
-    self.rect = self.img.get_rect()
 
   def start_flicker(self, duration=30):
     self.flicker = duration
 
   def collides_with_wall(self, entities):
-    return entities.any("wall", lambda x: x.touches_rect(self))
+    return entities.one("map").collides(self)
 
-  def touches_point(self, point):
-    return self.x <= point.x <= self.x + self.size and\
-           self.y <= point.y <= self.y + self.size
-  
-  def touches_rect(self, other):
-    if hasattr(self, 'uid') and hasattr(other, 'uid') and self.uid == other.uid: 
-       return False
-    return rect_intersect(self, other)
+  # Call after changing x or y so overlap queries can find us.
+  def moved(self):
+    if self.manager is not None and self.spatial:
+      self.manager.spatial.move(self)
+
+  # Group membership. Always go through these once the entity has been added
+  # to an Entities, so that its group index stays in sync.
 
   def add_group(self, group):
-    self.groups.append(group)
+    self.mask |= Groups.bit(group)
+    if self.manager is not None:
+      self.manager.index(self, group)
+
+  def remove_group(self, group):
+    self.mask &= ~Groups.bit(group)
+    if self.manager is not None:
+      self.manager.unindex(self, group)
 
   # Add and remove callbacks
 
   def on(self, event, callback):
+    if self.events is None:
+      self.events = {}
+
     if event in self.events:
       self.events[event].append(callback)
     else:
       self.events[event] = [callback]
   
   def off(self, event, callback = None):
+    if self.events is None:
+      return
+
     if callback is None:
       self.events[event] = []
     else:
       self.events[event].remove(callback)
   
   def emit(self, event):
+    if self.events is None:
+      return
+
     for callback in self.events:
       callback()
   
-  # How high/low this object is
-  def depth(self):
-    return 0
-  
-  # Methods that must be implemented if you extend Entity
-  def groups(self):
-    return groups
-  
+  # Entities.update_all counts flicker down once a tick, for whatever is
+  # visible.
   def render(self, screen):
-    if self.flicker > 0:
-      self.flicker -= 1
-      if self.flicker % 4 >= 2:
-        return
+    if self.flicker % 4 >= 2:
+      return
+
+    screen.blit(self.img, (self.x, self.y))
 
-    self.rect.x = self.x
-    self.rect.y = self.y
-    screen.blit(self.img, self.rect)
+  # The area render() draws to.
+  def bounds(self):
+    return pygame.Rect((self.x, self.y), self.img.get_size())
+
+  # Everything that decides what render() draws. If this and bounds() are
+  # the same as last frame, so are our pixels.
+  def appearance(self):
+    return (self.img, self.flicker % 4 >= 2)
 
   def update(self, entities):
     raise "UnimplementedUpdateException"
 
-class Tile(Entity):
-  def __init__(self, x, y, tx, ty, wall=False):
-    super(Tile, self).__init__(x, y, ["renderable", "updateable"], tx, ty, "tiles.bmp")
+# Tiles, treasure and rocks never do anything on their own, so they aren't
+# updateable.
+
+class TileTable:
+  """ A room's plain tiles, a column per field instead of an object each.
+  A room has hundreds and all they do is get baked into its background, so
+  they aren't renderable themselves. Entities still finds them in queries,
+  and hands out a Tile for each row that matches. """
+  def __init__(self, sheet, width):
+    self.sheet = sheet
+    self.width = width # In tiles, across and down.
+
+    self.x = array("h")
+    self.y = array("h")
+    self.src_x = array("B")
+    self.src_y = array("B")
+    self.mask = array("l")
+    self.alive = bytearray()
+
+    # Tile index, row by row => the row of the tile there, or -1.
+    self.cells = array("h", [-1]) * (width * width)
+
+    self.groups = 0 # Every group any row has been in.
+    self.live = 0
+    self.handles = {}
+    self.manager = None
+
+  def append(self, i, j, src_x, src_y, mask):
+    self.cells[j * self.width + i] = len(self.mask)
+
+    self.x.append(i * TILE_SIZE)
+    self.y.append(j * TILE_SIZE)
+    self.src_x.append(src_x)
+    self.src_y.append(src_y)
+    self.mask.append(mask)
+    self.alive.append(1)
+
+    self.groups |= mask
+    self.live += 1
+
+  def tile(self, row):
+    if row not in self.handles:
+      self.handles[row] = Tile(self, row)
+    return self.handles[row]
+
+  def set_mask(self, row, mask):
+    self.mask[row] = mask
+    self.groups |= mask
+
+  def remove(self, row):
+    """ For good, the room won't bring it back. """
+    if self.alive[row]:
+      self.alive[row] = 0
+      self.live -= 1
+
+  def rows(self, query, rows=None):
+    """ The live rows (of rows, or all of them) that query matches. """
+    include, exclude = query.include_mask, query.exclude_mask
+    if self.groups & include != include:
+      return []
+
+    if rows is None:
+      rows = xrange(len(self.mask))
+
+    mask, alive = self.mask, self.alive
+    found = [r for r in rows if alive[r] and mask[r] & include == include and not mask[r] & exclude]
+
+    if query.tests:
+      found = [r for r in found if query.passes(self.tile(r))]
+    return found
+
+  def near(self, rect, query):
+    """ Same as rows, but only for tiles that might touch rect. """
+    last = self.width - 1
+    first_i, first_j = max(0, int(rect.x // TILE_SIZE) - 1), max(0, int(rect.y // TILE_SIZE) - 1)
+    last_i, last_j = min(last, int((rect.x + rect.size) // TILE_SIZE)), min(last, int((rect.y + rect.size) // TILE_SIZE))
+
+    cells = self.cells
+    rows = [cells[j * self.width + i] for j in range(first_j, last_j + 1) for i in range(first_i, last_i + 1)]
+    return self.rows(query, [r for r in rows if r != -1])
 
-    if wall: self.groups.append("wall")
-  
-  def update(self, entities):
-    pass
- 
-  def depth(self):
-    return 0
+  def render(self, screen):
+    for r in xrange(len(self.mask)):
+      if self.alive[r]:
+        screen.blit(TileSheet.get(self.sheet, self.src_x[r], self.src_y[r]), (self.x[r], self.y[r]))
+
+class Tile(Placed):
+  """ A row of a TileTable, for when something asks for it. Tiles don't
+  flicker, listen or sleep, so this is a Placed rather than an Entity. """
+  __slots__ = ["table", "row"]
+
+  # The table answers near() itself.
+  spatial = False
+
+  size = TILE_SIZE
+
+  def __init__(self, table, row):
+    self.table = table
+    self.row = row
+
+  @property
+  def x(self):
+    return self.table.x[self.row]
+
+  @property
+  def y(self):
+    return self.table.y[self.row]
+
+  @property
+  def img(self):
+    return TileSheet.get(self.table.sheet, self.table.src_x[self.row], self.table.src_y[self.row])
+
+  @property
+  def manager(self):
+    return self.table.manager if self.table.alive[self.row] else None
+
+  @property
+  def mask(self):
+    return self.table.mask[self.row]
+
+  # Rows are found by their masks, there's no index to keep up to date.
+
+  def add_group(self, group):
+    self.table.set_mask(self.row, self.mask | Groups.bit(group))
+
+  def remove_group(self, group):
+    self.table.set_mask(self.row, self.mask & ~Groups.bit(group))
 
 class Treasure(Entity):
   def __init__(self, x, y, treasure_type):
-    super(Treasure, self).__init__(x, y, ["renderable", "updateable", "treasure"], 5, 0, "tiles.bmp")
+    super(Treasure, self).__init__(x, y, ["renderable", "treasure"], 5, 0, "tiles.bmp")
     self.treasure_type = treasure_type
-  
-  def update(self, entities):
-    pass
  
   def depth(self):
     return 0
@@ -256,10 +803,7 @@ class Treasure(Entity):
 
 class FlipRock(Entity):
   def __init__(self, x, y):
-    super(FlipRock, self).__init__(x, y, ["renderable", "updateable", "flippable"], 5, 1, "tiles.bmp")
-  
-  def update(self, entities):
-    pass
+    super(FlipRock, self).__init__(x, y, ["renderable", "flippable"], 5, 1, "tiles.bmp")
  
   def depth(self):
     return 2
@@ -267,56 +811,572 @@ class FlipRock(Entity):
 def isalambda(v):
   return isinstance(v, type(lambda: None)) and v.__name__ == '<lambda>'
 
-class Entities:
-  def __init__(self):
-    self.entities = []
-    self.entityInfo = []
-  
-  def remove(self, some_ent):
-    self.entities.remove(some_ent)
-
-  def render_all(self, screen):
-    time = self.one("map").current_state()
-
-    for e in sorted(self.get("renderable"), key=lambda x: x.depth()):
-      if "both" in e.groups:
-        e.render(screen)
-      if time == FUTURE and "future" in e.groups:
-        e.render(screen)
-      if time == PRESENT and "present" in e.groups:
-        e.render(screen)
-      if "both" not in e.groups and "future" not in e.groups and "present" not in e.groups:
-        e.render(screen)
+class Query:
+  """ A set of criteria parsed once. Strings are group names ("not x" excludes
+  group x), lambdas are arbitrary tests. Running a query starts from the
+  smallest included group, so it costs about as much as its result. """
+  def __init__(self, *criteria):
+    self.include = []
+    self.exclude = []
+    self.tests = []
 
-  def add(self, entity):
-    self.entities.append(entity)
-  
-  def elem_matches_criteria(self, elem, *criteria):
     for criterion in criteria:
       if isinstance(criterion, basestring):
-        if "not " in criterion:
-          if criterion[4:] in elem.groups:
-            return False
+        if criterion.startswith("not "):
+          self.exclude.append(criterion[4:])
         else:
-          if criterion not in elem.groups:
-            return False
+          self.include.append(criterion)
       elif isalambda(criterion):
-        if not criterion(elem):
-          return False
+        self.tests.append(criterion)
       else:
         raise "UnsupportedCriteriaType"
-    
+
+    self.include_mask = Groups.mask(self.include)
+    self.exclude_mask = Groups.mask(self.exclude) | REMOVED
+
+  def candidates(self, entities):
+    if not self.include:
+      return [e for e in entities.slots if e is not None]
+
+    return min((entities.members(g) for g in self.include), key=len)
+
+  def matches(self, entities, elem):
+    mask = elem.mask
+    if mask & self.include_mask != self.include_mask or mask & self.exclude_mask:
+      return False
+
+    return self.passes(elem)
+
+  def passes(self, elem):
+    """ Just the tests that aren't about groups. """
+    for test in self.tests:
+      if not test(elem):
+        return False
+
     return True
-       
+
+  def loose(self, entities):
+    """ Matches that aren't in a TileTable. """
+    return [e for e in self.candidates(entities) if self.matches(entities, e)]
+
+  def run(self, entities):
+    found = self.loose(entities)
+    for table in entities.tables:
+      found.extend(table.tile(r) for r in table.rows(self))
+
+    return found
+
+  def first(self, entities):
+    for e in self.candidates(entities):
+      if self.matches(entities, e):
+        return e
+
+    for table in entities.tables:
+      rows = table.rows(self)
+      if rows:
+        return table.tile(rows[0])
+
+    return None
+
+EMPTY_GROUP = OrderedDict()
+
+class Pool:
+  """ Spare instances of an Entity class, recycled instead of allocated.
+  The class needs a spare() that makes a blank one, a reset() that takes
+  the same arguments as its constructor, and a POOL_SIZE to start with.
+
+  Released entities only become spare again at the end of the tick, since
+  the update loop may still be holding on to them. """
+  def __init__(self, cls):
+    self.cls = cls
+    self.spares = [cls.spare() for i in range(cls.POOL_SIZE)]
+    self.released = []
+
+  def acquire(self, *args):
+    if not self.spares:
+      return self.cls(*args)
+
+    entity = self.spares.pop()
+    entity.reset(*args)
+    return entity
+
+  def release(self, entity):
+    self.released.append(entity)
+
+  def end_tick(self):
+    self.spares.extend(self.released)
+    self.released = []
+
+class Projectiles:
+  """ Every live bullet's position, direction, speed and size in parallel
+  arrays, so a tick moves them and checks them against walls, the room edges
+  and FlipRocks all at once instead of one update() each. The Bullets stay
+  around to be drawn; only the ones that hit a rock go back through
+  Bullet.flip.
+
+  Bullets fired during a tick start moving the next one, and dead ones are
+  squeezed out in order, so bullets hit rocks in the order they were fired,
+  same as when they updated themselves. Without numpy, that's what they
+  do. """
+  FIELDS = ["x", "y", "dx", "dy", "speed", "size"]
+
+  def __init__(self):
+    self.bullets = []
+    self.fired = []
+    self.removed = set()
+    self.arrays = None
+
+    if numpy is not None:
+      self.arrays = dict((f, numpy.zeros(0, numpy.int32)) for f in Projectiles.FIELDS)
+
+  def __len__(self):
+    return len(self.bullets) + len(self.fired)
+
+  def add(self, bullet):
+    self.fired.append(bullet)
+
+  def remove(self, bullet):
+    if bullet in self.fired:
+      self.fired.remove(bullet)
+    else:
+      self.removed.add(bullet) # Squeezed out later, all at once.
+
+  def squeeze(self):
+    alive = [b not in self.removed for b in self.bullets]
+    self.bullets = [b for b, live in zip(self.bullets, alive) if live]
+
+    if self.arrays is not None:
+      keep = numpy.array(alive, bool)
+      for f in Projectiles.FIELDS:
+        self.arrays[f] = self.arrays[f][keep]
+
+    self.removed = set()
+
+  def join(self):
+    """ Take on the bullets fired since the last call. Called as a tick
+    starts, since those are the ones that get moved this tick. """
+    if self.removed:
+      self.squeeze()
+    if not self.fired:
+      return
+
+    if self.arrays is not None:
+      for f in Projectiles.FIELDS:
+        new = numpy.array([getattr(b, f) for b in self.fired], numpy.int32)
+        self.arrays[f] = numpy.concatenate((self.arrays[f], new))
+
+    self.bullets.extend(self.fired)
+    self.fired = []
+
+  def step(self, entities):
+    if self.removed:
+      self.squeeze()
+
+    if self.arrays is None:
+      for b in list(self.bullets):
+        if b not in self.removed:
+          b.update(entities)
+    elif self.bullets:
+      self.step_arrays(entities)
+
+  def step_arrays(self, entities):
+    a = self.arrays
+    a["x"] += a["dx"] * a["speed"]
+    a["y"] += a["dy"] * a["speed"]
+
+    x, y, size = a["x"], a["y"], a["size"]
+    m = entities.one("map")
+
+    destroy = m.rects_collide(x, y, size)
+
+    # Same test as Entity.touches_rect, with the bullet as the first rect.
+    # Rocks are few, so loop over them.
+    rocks = entities.get("flippable", GameState.state)
+    hit = numpy.zeros((len(rocks), len(x)), bool)
+    for r, rock in enumerate(rocks):
+      left, top = rock.x, rock.y
+      right, bottom = left + rock.size, top + rock.size
+      hit[r] = (((left <= x) & (x <= right)) | ((left <= x + size) & (x + size <= right))) &\
+               (((top <= y) & (y <= bottom)) | ((top <= y + size) & (y + size <= bottom)))
+
+    xs, ys = x.tolist(), y.tolist()
+    for i, b in enumerate(self.bullets):
+      b.x, b.y = xs[i], ys[i]
+
+    # One at a time, since a rock flipped by one bullet is gone for the next.
+    if rocks:
+      for i in numpy.flatnonzero(hit.any(axis=0)):
+        flip_these = [rock for r, rock in enumerate(rocks) if hit[r, i] and rock.has(GameState.state)]
+        for rock in flip_these:
+          self.bullets[i].flip(rock)
+        if flip_these:
+          destroy[i] = True
+
+    for i in numpy.flatnonzero(destroy):
+      entities.release(self.bullets[i])
+
+# Groups that decide whether and where something is drawn.
+RENDER_GROUPS = set(["renderable", "both", "present", "future"])
+
+class RenderQueue:
+  """ Renderables bucketed by timeline and then depth, kept up to date as
+  entities are added, removed and flipped, so drawing a frame is one pass
+  over the buckets of the current timeline instead of a sort. Depths are
+  fixed per class, so we only ask for them once. """
+  def __init__(self):
+    self.buckets = {"both": {}, "present": {}, "future": {}}
+    self.depths = []
+    self.placed = {}
+
+  def timeline(self, entity):
+    if not entity.has("both"):
+      if entity.has("present"): return "present"
+      if entity.has("future"): return "future"
+    # Also things that aren't in any timeline, they show up everywhere.
+    return "both"
+
+  def add(self, entity):
+    timeline, depth = self.placed[entity] = (self.timeline(entity), entity.depth())
+
+    if depth not in self.buckets[timeline]:
+      self.buckets[timeline][depth] = OrderedDict()
+      if depth not in self.depths:
+        bisect.insort(self.depths, depth)
+
+    self.buckets[timeline][depth][entity] = True
+
+  def remove(self, entity):
+    if entity in self.placed:
+      timeline, depth = self.placed.pop(entity)
+      del self.buckets[timeline][depth][entity]
+
+  def update(self, entity):
+    """ Re-file entity after its groups changed. """
+    if not entity.has("renderable"):
+      self.remove(entity)
+    elif self.placed.get(entity, (None,))[0] != self.timeline(entity):
+      self.remove(entity)
+      self.add(entity)
+
+  def visible(self, time):
+    """ Everything drawn in timeline time, bottom to top. Within a depth,
+    things in both timelines go under things in just this one. """
+    both = self.buckets["both"]
+    only = self.buckets["future" if time == FUTURE else "present"]
+    shown = []
+
+    for depth in self.depths:
+      if depth in both: shown.extend(both[depth])
+      if depth in only: shown.extend(only[depth])
+
+    return shown
+
+# Refers to an entity without keeping it alive in our minds: once it's
+# removed, its slot's generation moves on and Entities.resolve says None,
+# even if the slot (or the entity, if it's pooled) gets used again.
+Handle = namedtuple("Handle", "slot generation")
+
+class Entities:
+  """ Everything in the game. Entities live in slots, which get reused,
+  and each slot counts how many times it's been emptied, its generation.
+
+  While update_all is running the updateables, add() and remove() only
+  queue up what to do, and it all happens once they're done. Until then,
+  removed entities are already gone as far as queries and the rest of the
+  update loop can tell, and added ones aren't there yet. """
+  def __init__(self):
+    self.slots = []
+    self.generations = array("L")
+    self.free = []
+    self.entityInfo = []
+    self.by_group = {}
+    self.queries = {}
+    self.spatial = SpatialHash()
+    self.render_queue = RenderQueue()
+
+    # What render_dirty drew last time: entity => (appearance, bounds).
+    self.drawn = None
+
+    # Sleeping entities with a wake up time: tick => [entity].
+    self.ticks = 0
+    self.alarms = {}
+
+    # class => Pool
+    self.pools = {}
+
+    self.projectiles = Projectiles()
+
+    # TileTables whose rows count as entities too.
+    self.tables = []
+
+    # How far the frame being drawn is from the last tick to the next, 0 to
+    # 1, for anything that wants to draw between ticks.
+    self.alpha = 0.0
+
+    # While deferring, what add() and remove() were asked to do, in order:
+    # ("add", entity) or ("remove", entity, the groups it was indexed under).
+    self.deferring = False
+    self.commands = []
   
-  def get(self, *criteria):
-    results = []
+  def index(self, entity, group):
+    if group not in self.by_group:
+      self.by_group[group] = OrderedDict()
+    self.by_group[group][entity] = True
 
-    for entity in self.entities:
-      if self.elem_matches_criteria(entity, *criteria):
-        results.append(entity)
-    
-    return results
+    if group in RENDER_GROUPS:
+      self.render_queue.update(entity)
+
+  def unindex(self, entity, group):
+    if group in RENDER_GROUPS:
+      self.render_queue.update(entity)
+
+    self.by_group[group].pop(entity, None)
+
+  def members(self, group):
+    return self.by_group.get(group, EMPTY_GROUP)
+
+  def remove(self, some_ent):
+    if isinstance(some_ent, Tile):
+      some_ent.table.remove(some_ent.row)
+      return
+
+    if some_ent.slot is None:
+      assert self.pending(some_ent), "removing %r, which was never added" % some_ent
+
+      # Added earlier in the loop, so never mind, or any alarm that came with it.
+      self.commands = [command for command in self.commands if command[1] is not some_ent]
+      return
+
+    if self.deferring:
+      self.commands.append(("remove", some_ent, some_ent.groups))
+      some_ent.mask |= REMOVED
+      some_ent.manager = None
+      return
+
+    self.unlink(some_ent, some_ent.groups)
+
+  def unlink(self, some_ent, groups):
+    """ Take some_ent out of everything it was indexed under groups. """
+    self.slots[some_ent.slot] = None
+    self.generations[some_ent.slot] += 1
+    self.free.append(some_ent.slot)
+
+    for group in groups:
+      self.by_group[group].pop(some_ent, None)
+    self.spatial.remove(some_ent)
+    self.render_queue.remove(some_ent)
+    if "bullet" in groups:
+      self.projectiles.remove(some_ent)
+
+    some_ent.slot = None
+    some_ent.manager = None
+    some_ent.mask &= ~REMOVED
+
+  def visible(self):
+    """ Renderables that exist in the current timeline, bottom to top. """
+    return self.render_queue.visible(self.one("map").current_state())
+
+  def render_all(self, screen):
+    if Profiler.on:
+      Profiler.each("render", self.visible(), lambda e: e.render(screen))
+      return
+
+    for e in self.visible():
+      e.render(screen)
+
+  def render_dirty(self, screen):
+    """ Like render_all, but only redraws where something changed since the
+    last call, going by each entity's bounds() and appearance(). Returns the
+    rects that need to be presented. """
+    shown = self.visible()
+    now = dict((e, (e.appearance(), e.bounds())) for e in shown)
+
+    if self.drawn is None:
+      screen.fill((255, 255, 255))
+      Profiler.each("render", shown, lambda e: e.render(screen))
+
+      self.drawn = now
+      return [screen.get_rect()]
+
+    dirty = []
+    for e in now:
+      if self.drawn.get(e) != now[e]:
+        dirty.append(now[e][1])
+        if e in self.drawn:
+          dirty.append(self.drawn[e][1])
+    for e in self.drawn:
+      if e not in now:
+        dirty.append(self.drawn[e][1])
+
+    self.drawn = now
+    dirty = merge_rects(dirty)
+
+    for rect in dirty:
+      screen.set_clip(rect)
+      screen.fill((255, 255, 255), rect)
+      Profiler.each("render", [e for e in shown if now[e][1].colliderect(rect)], lambda e: e.render(screen))
+    screen.set_clip(None)
+
+    return dirty
+
+  # Only "updateable" entities get updated each tick. Anything that has
+  # nothing to do for a while should sleep instead of returning early every
+  # tick, so that the cost of a tick follows what's going on, not how much
+  # stuff there is.
+
+  def sleep(self, entity, ticks=None):
+    """ Stop updating entity. If ticks is given, it gets woken up that many
+    ticks from now, otherwise only wake() will do it. """
+    if entity.has("updateable"):
+      entity.remove_group("updateable")
+
+    entity.alarm = None
+    if ticks is None:
+      return
+
+    if entity.slot is None:
+      assert self.pending(entity), "%r can't sleep for %d ticks, it was never added" % (entity, ticks)
+      self.commands.append(("sleep", entity, ticks)) # Set the alarm once it's in.
+    else:
+      entity.alarm = self.ticks + ticks
+      self.alarms.setdefault(entity.alarm, []).append(self.handle(entity))
+
+  def wake(self, entity):
+    entity.alarm = None
+    if not entity.has("updateable"):
+      entity.add_group("updateable")
+
+  def update_all(self):
+    self.ticks += 1
+    self.projectiles.join()
+
+    for handle in self.alarms.pop(self.ticks, []):
+      e = self.resolve(handle)
+      if e is not None and e.alarm == self.ticks:
+        self.wake(e)
+
+    def update(e):
+      if e.manager is self: # Not removed earlier in the loop.
+        e.update(self)
+
+    self.deferring = True
+    try:
+      if Profiler.on:
+        Profiler.each("update", self.get("updateable"), update)
+      else:
+        for e in self.get("updateable"):
+          update(e)
+    finally:
+      self.deferring = False
+      self.flush()
+
+    Profiler.begin("projectiles")
+    self.projectiles.step(self)
+    Profiler.end()
+
+    # Here and not when drawing, since frames get skipped.
+    for e in self.visible():
+      if e.flicker > 0:
+        e.flicker -= 1
+
+    for pool in self.pools.values():
+      pool.end_tick()
+
+  def pool(self, cls):
+    if cls not in self.pools:
+      self.pools[cls] = Pool(cls)
+    return self.pools[cls]
+
+  def release(self, entity):
+    """ remove() an entity that came from pool(), and hand it back. """
+    self.remove(entity)
+    self.pool(type(entity)).release(entity)
+
+  def flush(self):
+    """ Do what add() and remove() put off. """
+    commands, self.commands = self.commands, []
+    for command in commands:
+      if command[0] == "remove":
+        self.unlink(command[1], command[2])
+      elif command[0] == "sleep":
+        self.sleep(command[1], command[2])
+      else:
+        self.add(command[1])
+
+  def pending(self, entity):
+    """ Was entity add()ed during this update, and not yet really added? """
+    return self.deferring and ("add", entity) in self.commands
+
+  def handle(self, entity):
+    assert entity.slot is not None, "%r has no handle until it's really added" % entity
+    return Handle(entity.slot, self.generations[entity.slot])
+
+  def resolve(self, handle):
+    """ The entity handle refers to, or None if it's been removed since. """
+    if self.generations[handle.slot] != handle.generation:
+      return None
+    return self.slots[handle.slot]
+
+  def add(self, entity):
+    if self.deferring:
+      self.commands.append(("add", entity))
+      entity.mask &= ~REMOVED # If it was removed first, it's back now.
+      return
+
+    if self.free:
+      entity.slot = self.free.pop()
+      self.slots[entity.slot] = entity
+    else:
+      entity.slot = len(self.slots)
+      self.slots.append(entity)
+      self.generations.append(0)
+
+    entity.manager = self
+    for group in entity.groups:
+      self.by_group.setdefault(group, OrderedDict())[entity] = True
+    if entity.has("renderable"):
+      self.render_queue.add(entity)
+    if entity.spatial:
+      self.spatial.insert(entity)
+    if entity.has("bullet"):
+      self.projectiles.add(entity)
+
+  def attach(self, table):
+    """ Add all of a TileTable's live rows. """
+    if table.manager is None:
+      table.manager = self
+      self.tables.append(table)
+
+  def detach(self, table):
+    if table.manager is self:
+      table.manager = None
+      self.tables.remove(table)
+
+  def query(self, *criteria):
+    """ Compile criteria into a reusable Query. Pure group lookups are
+    memoized, since those are the ones we run every frame. """
+    if any(not isinstance(c, basestring) for c in criteria):
+      return Query(*criteria)
+
+    if criteria not in self.queries:
+      self.queries[criteria] = Query(*criteria)
+    return self.queries[criteria]
+
+  def compile(self, criteria):
+    if Profiler.on:
+      Profiler.count("queries")
+
+    if len(criteria) == 1 and isinstance(criteria[0], Query):
+      return criteria[0]
+
+    tags = tuple(c for c in criteria if isinstance(c, basestring))
+    if len(tags) == len(criteria):
+      return self.query(*tags)
+
+    return Query(*criteria)
+
+  def get(self, *criteria):
+    return self.compile(criteria).run(self)
  
   def one(self, *criteria):
     results = self.get(*criteria)
@@ -325,26 +1385,166 @@ class Entities:
     return results[0]
   
   def any(self, *criteria):
-    return len(self.get(*criteria)) > 0
+    return self.compile(criteria).first(self) is not None
+
+  # Same as get and any, but only considering entities near rect. Any
+  # criteria that actually test overlap still have to be passed in.
+
+  def near(self, rect, *criteria):
+    query = self.compile(criteria)
+    found = [e for e in self.spatial.near(rect) if query.matches(self, e)]
+    for table in self.tables:
+      found.extend(table.tile(r) for r in table.near(rect, query))
+
+    return found
+
+  def any_near(self, rect, *criteria):
+    query = self.compile(criteria)
+    for e in self.spatial.near(rect):
+      if query.matches(self, e):
+        return True
+    for table in self.tables:
+      if table.near(rect, query):
+        return True
+    return False
 
   def remove_all(self, *criteria):
-    retained = []
-
-    for entity in self.entities:
-      if not self.elem_matches_criteria(entity, *criteria):
-        retained.append(entity)
-    
-    self.entities = retained
-
+    query = self.compile(criteria)
+    for entity in query.loose(self):
+      self.remove(entity)
+
+    # Rows are gone for good, like any removed tile. To put a table aside
+    # and bring it back later, detach it instead.
+    for table in self.tables:
+      for row in table.rows(query):
+        table.remove(row)
+
+
+# Tile kinds, as classified from the pixels of a room image.
+(UNKNOWN, FLOOR, STONE, GRAY, FUTURE_STONE, PATH, GRASS, WALL, NPC, TRAVELLER,
+ FLIPROCK) = range(11)
+
+ROOM_PALETTE = { (255, 255, 255) : FLOOR
+               , (100, 200, 100) : STONE        # Stone in present.
+               , (230, 230, 230) : GRAY         # Gray tile in future.
+               , (51, 51, 51)    : FUTURE_STONE # Stone (unflippable) in future
+               , (0, 150, 0)     : PATH
+               , (0, 254, 0)     : GRASS
+               , (0, 0, 0)       : WALL
+               , (0, 255, 0)     : NPC
+               , (255, 255, 0)   : TRAVELLER
+               , (50, 50, 50)    : FLIPROCK
+               }
+
+# kind => (tile x, tile y, is it a wall)
+PLAIN_TILES = { FLOOR        : (0, 0, False)
+              , STONE        : (4, 2, True)
+              , GRAY         : (4, 1, False)
+              , FUTURE_STONE : (6, 1, True)
+              , PATH         : (4, 0, False)
+              , GRASS        : (3, 1, False)
+              , WALL         : (1, 0, True)
+              }
+
+WALL_KINDS = set(k for k in PLAIN_TILES if PLAIN_TILES[k][2])
+
+# The palette as a sorted lookup table of packed 0xRRGGBB colors, and as
+# 3 byte strings for when we don't have numpy.
+PALETTE_KEYS = sorted((r << 16) | (g << 8) | b for r, g, b in ROOM_PALETTE)
+PALETTE_KINDS = [ROOM_PALETTE[(k >> 16, (k >> 8) & 0xff, k & 0xff)] for k in PALETTE_KEYS]
+PALETTE_BYTES = dict((chr(r) + chr(g) + chr(b), ROOM_PALETTE[(r, g, b)]) for r, g, b in ROOM_PALETTE)
+
+def decode_room(surface):
+  """ Classify every pixel of a room image in one go instead of calling
+  get_at on each. Returns a bytearray of kinds, row by row; colors not in
+  the palette come back as UNKNOWN. """
+  if numpy is not None:
+    rgb = pygame.surfarray.array3d(surface).astype(numpy.int32)
+    packed = ((rgb[:, :, 0] << 16) | (rgb[:, :, 1] << 8) | rgb[:, :, 2]).T
+
+    keys = numpy.array(PALETTE_KEYS)
+    found = numpy.minimum(numpy.searchsorted(keys, packed), len(keys) - 1)
+    kinds = numpy.where(keys[found] == packed, numpy.array(PALETTE_KINDS)[found], UNKNOWN)
+
+    return bytearray(kinds.astype(numpy.uint8).tostring())
+
+  data = pygame.image.tostring(surface, "RGB")
+  return bytearray(PALETTE_BYTES.get(data[k:k + 3], UNKNOWN) for k in xrange(0, len(data), 3))
+
+# Which map each timeline's rooms come from, and the group their tiles are
+# in, so only the current timeline's get drawn and found.
+MAP_FILES = {PRESENT: "map.bmp", FUTURE: "map2.bmp"}
+TIMELINE_GROUPS = {PRESENT: "present", FUTURE: "future"}
+MAP_TIMELINES = dict((MAP_FILES[t], TIMELINE_GROUPS[t]) for t in MAP_FILES)
+
+class Room:
+  """ One decoded room of one map. Its tiles are built once and handed back
+  every time we return, so whatever happened to them sticks. """
+  def __init__(self, key, kinds, walls, tiles, others):
+    self.key = key # (map name, map x, map y)
+    self.kinds = kinds
+    self.walls = walls
+    self.tiles = tiles   # A TileTable of the plain ones.
+    self.others = others # Everything else that starts out in the room.
+    self.background = None
+
+  def bake(self, size):
+    """ Draw the room's plain tiles onto one surface. They never move, so
+    the Map blits this instead. """
+    self.background = pygame.Surface((size, size)).convert(Display.get())
+    self.background.fill((255, 255, 255))
+
+    self.tiles.render(self.background)
+
+  def forget_removed(self):
+    """ Drop what was removed while we were in the room (opened treasure
+    and the like), so it doesn't come back. Removed tiles stay dead in their
+    table already. Returns where, as tile (i, j)s, everything removed from
+    the room so far was. """
+    removed = [(e.x / TILE_SIZE, e.y / TILE_SIZE) for e in self.others if e.manager is None]
+    self.others = [e for e in self.others if e.manager is not None]
+
+    tiles = self.tiles
+    removed.extend((tiles.x[r] / TILE_SIZE, tiles.y[r] / TILE_SIZE) for r in xrange(len(tiles.mask)) if not tiles.alive[r])
+    return removed
 
 class Map(Entity):
+  spatial = False
+
   def __init__(self, startx=0, starty=0):
-    super(Map, self).__init__(0, 0, ["updateable", "map"])
+    super(Map, self).__init__(0, 0, ["renderable", "updateable", "map"])
     self.map_coords = [startx, starty]
     self.map_width = 20
     self.abs_map_width = TILE_SIZE * self.map_width
     self.map_rect = Rect(0, 0, self.abs_map_width, self.abs_map_width)
 
+    # One byte per tile of the current room, row by row: 1 if it's a wall.
+    self.walls = bytearray(self.map_width * self.map_width)
+
+    self.rooms = LRUCache(ROOM_CACHE_SIZE)
+    self.room = None
+
+    # PRESENT/FUTURE => that timeline of the room we're in. Both are loaded
+    # and added at once, so flipping between them is cheap.
+    self.timelines = {}
+
+    # Builds the rooms we're headed for before we get there.
+    self.prefetcher = Prefetcher(self.build_room)
+
+    # (map_x, map_y) => that room's FlipRocks. Not in self.rooms, since they
+    # are in both timelines and must never be forgotten.
+    self.flippables = {}
+
+    # map name => set of (map x, map y, i, j): tiles and entities that have
+    # been removed for good. Also not in self.rooms, so a room that falls
+    # out of the cache doesn't get them back when it's built again.
+    self.removed = dict((map_name, set()) for map_name in MAP_FILES.values())
+
+    # Load the maps now, on this thread. Otherwise the prefetcher could be
+    # the first to want one, and loading a sheet isn't safe off of it.
+    for map_name in MAP_FILES.values():
+      self.room_grid(map_name)
+
     self.current = PRESENT
     GameState.state = "present"
     self.map_name = "map.bmp"
@@ -352,27 +1552,113 @@ class Map(Entity):
   def current_state(self):
     return self.current    
 
+  # The static part of the room, drawn under everything else.
+  def render(self, screen):
+    screen.blit(self.room.background, (0, 0))
+
+  def bounds(self):
+    return pygame.Rect(0, 0, self.abs_map_width, self.abs_map_width)
+
+  def appearance(self):
+    return self.room.background
+
+  def depth(self):
+    return -1
+
   def switch(self, to_what, entities):
+    """ Flip timelines. The tiles of both are already in entities, in the
+    "present" or "future" group, which takes care of drawing and queries, so
+    all that's left is to point at the other room. """
     if to_what == self.current: 
       return
 
-    if to_what == FUTURE:
-      self.map_name = "map2.bmp"
-      GameState.state = "future"
-    else:
-      self.map_name = "map.bmp"
-      GameState.state = "present"
-
-    self.new_map(entities, True)
     self.current = to_what
+    self.map_name = MAP_FILES[to_what]
+    GameState.state = TIMELINE_GROUPS[to_what]
+
+    self.room = self.timelines[to_what]
+    self.walls = self.room.walls
 
   def contains(self, entity):
     return rect_contains(self.map_rect, entity)
 
+  def collides(self, rect, walls=None):
+    """ Does rect touch a wall of the current room (or of walls, if given)?
+    This gives the same answer as rect_intersect(wall, rect) against every
+    wall tile, but only looks at the few cells that could have a corner
+    inside rect. """
+    w = self.map_width
+    if walls is None:
+      walls = self.walls
+
+    first_x = max(0, int((rect.x - TILE_SIZE) // TILE_SIZE))
+    last_x = min(w - 1, int((rect.x + rect.size) // TILE_SIZE))
+    first_y = max(0, int((rect.y - TILE_SIZE) // TILE_SIZE))
+    last_y = min(w - 1, int((rect.y + rect.size) // TILE_SIZE))
+
+    left, right = rect.x, rect.x + rect.size
+    top, bottom = rect.y, rect.y + rect.size
+
+    for j in range(first_y, last_y + 1):
+      wall_y = j * TILE_SIZE
+      if not (top <= wall_y <= bottom or top <= wall_y + TILE_SIZE <= bottom):
+        continue
+
+      for i in range(first_x, last_x + 1):
+        if not walls[j * w + i]:
+          continue
+
+        wall_x = i * TILE_SIZE
+        if left <= wall_x <= right or left <= wall_x + TILE_SIZE <= right:
+          return True
+
+    return False
+
+  def collides_in(self, rect, time, map_x, map_y):
+    """ Would rect touch a wall in timeline time of room (map_x, map_y)?
+    Doesn't change anything, so we can ask before flipping or moving. """
+    if [map_x, map_y] == self.map_coords and time in self.timelines:
+      room = self.timelines[time]
+    else:
+      room = self.load_room(MAP_FILES[time], map_x, map_y)
+
+    return self.collides(rect, room.walls)
+
+  def rects_collide(self, x, y, size):
+    """ collides(), for a whole numpy array of rects at once. Returns, for
+    each rect, whether it touches a wall or isn't entirely in the room. """
+    w = self.map_width
+    walls = numpy.frombuffer(self.walls, numpy.uint8).reshape(w, w)
+    hit = (x < 0) | (y < 0) | (x + size > self.abs_map_width) | (y + size > self.abs_map_width)
+
+    # The columns and rows collides() would look at start here. There are
+    # at most size / TILE_SIZE + 3 of each.
+    first_x = (x - TILE_SIZE) // TILE_SIZE
+    first_y = (y - TILE_SIZE) // TILE_SIZE
+    span = int(size.max()) // TILE_SIZE + 3 if len(size) else 0
+
+    for dj in range(span):
+      j = first_y + dj
+      wall_y = j * TILE_SIZE
+      row = (j >= 0) & (j < w) &\
+            (((y <= wall_y) & (wall_y <= y + size)) | ((y <= wall_y + TILE_SIZE) & (wall_y + TILE_SIZE <= y + size)))
+
+      for di in range(span):
+        i = first_x + di
+        wall_x = i * TILE_SIZE
+        cell = row & (i >= 0) & (i < w) &\
+               (((x <= wall_x) & (wall_x <= x + size)) | ((x <= wall_x + TILE_SIZE) & (wall_x + TILE_SIZE <= x + size)))
+
+        hit |= cell & (walls[numpy.clip(j, 0, w - 1), numpy.clip(i, 0, w - 1)] == 1)
+
+    return hit
+
   def update(self, entities):
     # Check if we are on a new map.
     char = entities.one("character")
-    if self.contains(char): return
+    if self.contains(char):
+      self.prefetch_toward(char)
+      return
 
     # We are!
 
@@ -395,61 +1681,156 @@ class Map(Entity):
       char.move_delta(0, -self.abs_map_width)
 
 
-    self.map_coords = [new_mapx, new_mapy]
+    self.map_coords = self.wrap(new_mapx, new_mapy)
     self.new_map(entities)
 
   def cur_pos(self):
     return self.map_coords
 
-  def new_map(self, entities, just_a_flip=False):
-    if just_a_flip:
-      print "oho a flip"
-      entities.remove_all("both")
-    else:
-      entities.remove_all("map_element")
+  def make_entity(self, kind, x, y):
+    """ The entity for a tile kind that isn't plain, if any. """
+    if kind == TRAVELLER:
+      return TalkToMe(x, y, "traveller")
+    if kind == NPC:
+      return TalkToMe(x, y)
+
+    return None
+
+  def build_room(self, map_name, map_x, map_y, removed):
+    """ removed is self.removed[map_name], or a copy of it when this runs on
+    the prefetcher. """
+    kinds = self.room_kinds(map_name, map_x, map_y)
+    walls = bytearray(self.map_width * self.map_width)
+    tiles = TileTable("tiles.bmp", self.map_width)
+    others = []
+
+    groups = [MAP_TIMELINES[map_name], "map_element"]
+    mask, wall_mask = Groups.mask(groups), Groups.mask(groups + ["wall"])
 
-    self.current_map = TileSheet.get(self.map_name, *self.map_coords)
-    
     for i in range(self.map_width):
       for j in range(self.map_width):
-        data = self.current_map.get_at((i, j))
-        if data == (255, 255, 255):
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 0, 0)
-        if data == (100, 200, 100): #Stone in present.
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 4, 2, True)
-        if data == (230, 230, 230): #Gray tile in future.
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 4, 1)
-        if data == (51, 51, 51): #Stone (unflippable) in future
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 6, 1, True)
-
-        if data == (255, 255, 0, True):
-          tile = TalkToMe(i * TILE_SIZE, j * TILE_SIZE, "traveller")
-        if data == (50, 50, 50):
-          tile = FlipRock(i * TILE_SIZE, j * TILE_SIZE)
-
-          if self.current == PRESENT:
-            tile.groups.append("present")
-            tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 3, 1)
-          else:
-            tile.groups.append("future")
-            below = Tile(i * TILE_SIZE, j * TILE_SIZE, 4, 1)
-            below.add_group("both")
-            below.add_group("map_element")
-        if data == (0, 150, 0):
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 4, 0)
-        elif data == (0, 255, 0): #npc
-          tile = TalkToMe(i * TILE_SIZE, j * TILE_SIZE)
-        elif data == (0, 254, 0): #grass tile
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 3, 1)
-        elif data == (0, 0, 0):
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 1, 0)
-          tile.add_group("wall")
-
-        if "present" not in tile.groups and "future" not in tile.groups:
-          tile.groups.append("both")
-
-        tile.add_group("map_element")
-        entities.add(tile)
+        kind = kinds[j * self.map_width + i]
+
+        if kind in WALL_KINDS:
+          walls[j * self.map_width + i] = 1
+
+        if (map_x, map_y, i, j) in removed:
+          continue
+
+        if kind in PLAIN_TILES:
+          tx, ty, wall = PLAIN_TILES[kind]
+          tiles.append(i, j, tx, ty, wall_mask if wall else mask)
+        elif kind == FLIPROCK: # The rock itself is in self.flippables.
+          tiles.append(i, j, 4, 1, mask)
+        else:
+          entity = self.make_entity(kind, i * TILE_SIZE, j * TILE_SIZE)
+          if entity is None:
+            continue
+
+          for group in groups:
+            entity.add_group(group)
+          others.append(entity)
+
+    return Room((map_name, map_x, map_y), kinds, walls, tiles, others)
+
+  def load_room(self, map_name, map_x, map_y):
+    key = (map_name, map_x, map_y)
+    room = self.rooms.get(key)
+
+    if room is None:
+      room = self.prefetcher.take(key)
+      if room is None:
+        start = default_timer()
+        room = self.build_room(map_name, map_x, map_y, self.removed[map_name])
+        self.prefetcher.stalls.append((key, default_timer() - start))
+
+      room.bake(self.abs_map_width) # Makes surfaces, so not on the worker.
+      self.rooms.put(key, room)
+
+    return room
+
+  def room_kinds(self, map_name, map_x, map_y):
+    assets = Assets.get()
+    if assets is not None and assets.room_grid(map_name) is not None:
+      return assets.room(map_name, map_x, map_y, self.map_width * self.map_width)
+
+    return decode_room(TileSheet.get(map_name, map_x, map_y))
+
+  def room_grid(self, map_name):
+    """ How many rooms across and down map_name is. """
+    assets = Assets.get()
+    if assets is not None and assets.room_grid(map_name) is not None:
+      return assets.room_grid(map_name)
+
+    return TileSheet.size(map_name)
+
+  def room_exists(self, map_name, map_x, map_y):
+    width, height = self.room_grid(map_name)
+    return 0 <= map_x < width and 0 <= map_y < height
+
+  def wrap(self, map_x, map_y):
+    """ Walking off the edge of the world brings you back on the other side,
+    the way it did when -1 just indexed the last room. """
+    width, height = self.room_grid(self.map_name)
+    return [map_x % width, map_y % height]
+
+  def prefetch_toward(self, char):
+    """ Start building both timelines of the room char is walking toward,
+    once it's within PREFETCH_MARGIN of the edge. """
+    map_x, map_y = self.map_coords
+    far = self.abs_map_width - PREFETCH_MARGIN - char.size
+    ahead = []
+
+    if char.x < PREFETCH_MARGIN: ahead.append((map_x - 1, map_y))
+    if char.x > far: ahead.append((map_x + 1, map_y))
+    if char.y < PREFETCH_MARGIN: ahead.append((map_x, map_y - 1))
+    if char.y > far: ahead.append((map_x, map_y + 1))
+
+    for x, y in ahead:
+      x, y = self.wrap(x, y)
+      for map_name in MAP_FILES.values():
+        if (map_name, x, y) not in self.rooms and self.room_exists(map_name, x, y):
+          self.prefetcher.want((map_name, x, y), frozenset(self.removed[map_name]))
+
+  def flippables_at(self, map_x, map_y):
+    """ FlipRocks are drawn in the future map, but they start out in the
+    future and get shot between timelines, so they're kept per room. """
+    if (map_x, map_y) not in self.flippables:
+      kinds = self.load_room("map2.bmp", map_x, map_y).kinds
+      rocks = []
+
+      for k, kind in enumerate(kinds):
+        if kind == FLIPROCK:
+          rock = FlipRock((k % self.map_width) * TILE_SIZE, (k / self.map_width) * TILE_SIZE)
+          rock.add_group("future")
+          rock.add_group("map_element")
+          rocks.append(rock)
+
+      self.flippables[(map_x, map_y)] = rocks
+
+    return self.flippables[(map_x, map_y)]
+
+  def new_map(self, entities):
+    with Profiler.timing("new_map"):
+      for room in self.timelines.values():
+        map_name, map_x, map_y = room.key
+        self.removed[map_name].update((map_x, map_y, i, j) for i, j in room.forget_removed())
+        entities.detach(room.tiles) # Not remove_all: the tiles come back with the room.
+
+      entities.remove_all("map_element")
+
+      for time in [PRESENT, FUTURE]:
+        room = self.timelines[time] = self.load_room(MAP_FILES[time], *self.map_coords)
+        entities.attach(room.tiles)
+        for entity in room.others:
+          entities.add(entity)
+
+      self.room = self.timelines[self.current]
+      self.walls = self.room.walls
+
+      for rock in self.flippables_at(*self.map_coords):
+        if rock.manager is None:
+          entities.add(rock)
 
 class UpKeys:
   """ Simple abstraction to check for recent key released behavior. """
@@ -498,23 +1879,30 @@ class TalkToMe(Entity):
 
   def talk_to(self, who, entities):
     entities.remove_all("text", "not actiontext")
-    next_text = DialogData.get_data(who, self.text_state, *entities.one("map").cur_pos())
+    script = Dialog.get()
 
-    if "GET" in next_text:
-      who.add_to_inventory(next_text.split(" ")[1])
-      # stop here, dont actually show this text, but do show next one.
-      self.text_state += 1
-      return self.talk_to(who, entities)
+    while True:
+      conversation = script.conversation(who, GameState.state, *entities.one("map").cur_pos())
+      node = conversation[self.text_state % len(conversation)]
 
-    if "DESTROY" in next_text:
-      entities.remove(self)
+      if node.kind == dialog.GET:
+        # Doesn't get shown, the next line does.
+        who.add_to_inventory(node.text)
+        self.text_state += 1
+        continue
 
-    if "ADVANCESTATE" in next_text:
-      GameState.current_state += 1
-      return
+      if node.kind == dialog.DESTROY:
+        self.text_state += 1
+        entities.remove(self)
+        return
 
-    entities.add(Text(self, next_text))
-    self.text_state += 1
+      if node.kind == dialog.ADVANCESTATE:
+        GameState.current_state += 1
+        return
+
+      entities.add(Text(self, node.text, node.lines))
+      self.text_state += 1
+      return
 
 """
 class Inventory(Entity):
@@ -527,45 +1915,87 @@ class Inventory(Entity):
   
 
 class Text(Entity):
-  def __init__(self, follow, contents):
+  spatial = False
+
+  FONT = ("nokiafc22.ttf", 12)
+  WIDTH = 300
+
+  # lines, if given, is contents already split up by wrap(), like dialog is.
+  def __init__(self, follow, contents, lines=None):
     super(Text, self).__init__(follow.x, follow.y, ["renderable", "updateable", "text"])
     self.contents = contents
+    self.lines = lines
     self.vis_text = ""
     self.follow = follow
     self.seen = 0
     self.ticks = 0
 
+  # Show one more letter every 3 ticks, sleeping in between, and go to sleep
+  # for good once it's all out.
   def update(self, entities):
-    self.ticks += 1
-    if self.ticks % 3 == 0:
-      self.seen += 1
-      if self.seen > len(self.contents):
-        self.vis_text = self.contents
-        self.groups.remove("updateable")
-        return
+    if self.ticks == 0: # First letter comes out on our third tick.
+      self.ticks = 1
+      entities.sleep(self, 2)
+      return
 
-  def render(self, screen, is_long=False):
-    self.vis_text = self.contents[:self.seen]
-    my_width = 300
-    my_font = pygame.font.Font("nokiafc22.ttf", 12)
+    self.seen += 1
+    if self.seen > len(self.contents):
+      self.vis_text = self.contents
+      entities.sleep(self)
+    else:
+      entities.sleep(self, 3)
 
+  @staticmethod
+  def wrap(contents):
+    return wrap_lines(contents, Fonts.get(*Text.FONT), Text.WIDTH)
+
+  def bounds(self):
+    my_width = Text.WIDTH
     my_rect = pygame.Rect((self.follow.x - my_width / 2, self.follow.y - 30, my_width, 70))
 
     if my_rect.x < 0:
       my_rect.x = 0
-    rendered_text = render_textrect(self.vis_text, my_font, my_rect, (10, 10, 10), (255, 255, 255), False, 1)
+    return my_rect
+
+  def appearance(self):
+    return self.contents[:self.seen]
+
+  # The first seen letters of lines. Wrapping only turns spaces into line
+  # breaks, so those are the first seen letters of contents too.
+  def revealed_lines(self):
+    shown = []
+    left = self.seen
+
+    for line in self.lines:
+      shown.append(line[:left])
+      left -= len(line)
+      if left <= 0:
+        break
+
+    return shown
+
+  def render(self, screen, is_long=False):
+    self.vis_text = self.contents[:self.seen]
+    my_rect = self.bounds()
+
+    if self.lines is None:
+      rendered_text = Fonts.render_textrect(self.vis_text, Text.FONT, my_rect, (10, 10, 10), (255, 255, 255), False, 1)
+    else:
+      rendered_text = Fonts.render_lines(self.revealed_lines(), Text.FONT, my_rect, (10, 10, 10), (255, 255, 255), False, 1)
 
     screen.blit(rendered_text, my_rect.topleft)
 
 class ActionText(Text):
   def __init__(self, contents):
     super(ActionText, self).__init__(Point(300, 80), contents)
-    self.groups.append("actiontext")
+    self.add_group("actiontext")
 
   def render(self, screen):
     super(ActionText, self).render(screen, True)
 
   def set_action(self, action):
+    if action != self.contents and self.manager is not None:
+      self.manager.wake(self) # Reveal the rest of it.
     self.contents = action
 
   def depth(self):
@@ -576,10 +2006,14 @@ class TextTimeout(Text):
     super(TextTimeout, self).__init__(follow, contents)
     self.time_left = time_left
 
+  # Called on our first tick, then we sleep until it's time to go.
   def update(self, entities):
     self.time_left -= 1
-    if self.time_left == 0:
+    if self.time_left <= 0:
       entities.remove(self)
+    else:
+      entities.sleep(self, self.time_left)
+      self.time_left = 1
 
 
 DOWN = 4
@@ -606,18 +2040,15 @@ class Character(Entity):
   def add_to_inventory(self, item):
     self.inventory.append(item)
 
-  def has_apple_pie(self):
-    return "FlippedApplePie" in self.inventory
-
   def interact(self, entities):
     # Talk
     if UpKeys.key_up(pygame.K_x):
-      npcs_near = entities.get("npc", lambda x: x.touches_rect(self))
+      npcs_near = [x for x in entities.near(self, "npc", GameState.state) if x.touches_rect(self)]
       for npc in npcs_near:
         npc.talk_to(self, entities)
         return
       
-      treasure_near = entities.get("treasure", lambda x: x.touches_rect(self.interact_rect))
+      treasure_near = self.touching(entities, "treasure")
       for treasure in treasure_near:
         treasure.talk_to(self, entities)
         return
@@ -632,47 +2063,51 @@ class Character(Entity):
 
     # Always allow PRESENT => FUTURE where you belong
     if up_pressed and m.current_state() == PRESENT:
-      m.switch(FUTURE, entities)
-      self.time_left = -1
-
-      if self.collides_with_wall(entities): # Fail - restore to safe spot.
-        self.start_flicker()
-        m.switch(FUTURE, entities)
-        self.move_abs(*self.safe_spot)
-        self.time_left = -1
+      self.return_to_future(entities)
     elif up_pressed and m.current_state() == FUTURE:
       # Player initiated, can instantly fail
-      m.switch(PRESENT, entities)
-      self.time_left = TIME_IN_FUTURE * TICKS_PER_SEC
-
-      if self.collides_with_wall(entities): # Fail.
+      if m.collides_in(self, PRESENT, *m.cur_pos()): # Fail.
         self.start_flicker()
-        m.switch(FUTURE, entities)
         self.time_left = -1
+      else:
+        m.switch(PRESENT, entities)
+        self.time_left = TIME_IN_FUTURE * TICKS_PER_SEC
 
     # Countdown back to past.
     self.time_left -= 1
     if self.time_left == 0:
-      m.switch(FUTURE, entities)
-      self.time_left = -1
+      self.return_to_future(entities)
 
-      if self.collides_with_wall(entities): # Fail - restore to safe spot.
-        self.start_flicker()
-        m.switch(FUTURE, entities)
-        self.move_abs(*self.safe_spot)
-        self.time_left = -1
+  def return_to_future(self, entities):
+    m = entities.one("map")
+
+    if m.collides_in(self, FUTURE, *m.cur_pos()): # Fail - restore to safe spot.
+      self.start_flicker()
+      self.move_abs(*self.safe_spot)
+
+    m.switch(FUTURE, entities)
+    self.time_left = -1
 
   def move_abs(self, x, y):
     self.x = x
     self.y = y
+    self.moved()
 
   def move_delta(self, dx, dy):
     self.x += dx
     self.y += dy
+    self.moved()
+
+  def touching(self, entities, group):
+    """ Everything in group, in this time, that touches interact_rect. The
+    group part is a plain memoized query; the touch test runs on what it
+    finds, since a lambda would get the criteria parsed again every tick. """
+    rect = self.interact_rect
+    return [x for x in entities.near(rect, group, GameState.state) if x.touches_rect(rect)]
 
   def update_action_icon(self, entities):
-    npcs_near = entities.get("npc", lambda x: x.touches_rect(self.interact_rect))
-    treasure_near = entities.get("treasure", lambda x: x.touches_rect(self.interact_rect))
+    npcs_near = self.touching(entities, "npc")
+    treasure_near = self.touching(entities, "treasure")
 
     actiontext = entities.one("actiontext")
     if len(npcs_near) > 0:
@@ -684,7 +2119,7 @@ class Character(Entity):
 
   def shoot_bullet(self, entities):
     if self.tick % 5 == 0:
-      entities.add(Bullet(self.x, self.y, self.orientation))
+      entities.add(entities.pool(Bullet).acquire(self.x, self.y, self.orientation))
 
   def update(self, entities):
     self.interact_rect = Rect(self.x - self.size, self.y - self.size, self.size * 3, self.size * 3)
@@ -714,6 +2149,8 @@ class Character(Entity):
     if self.collides_with_wall(entities):
       self.y -= dy
 
+    self.moved()
+
     if dx > 0: self.orientation = RIGHT
     if dx < 0: self.orientation = LEFT
     if dy > 0: self.orientation = DOWN
@@ -736,10 +2173,30 @@ class Character(Entity):
     return 99
 
 class Bullet(Entity):
+  """ Bullets come and go constantly, so they are slotted and pooled: get
+  them from entities.pool(Bullet) and get rid of them with
+  entities.release(). """
+  __slots__ = ["speed", "dx", "dy"]
+
+  POOL_SIZE = 16
+
+  # Entities.projectiles moves them and does their collisions.
+  spatial = False
+
   def __init__(self, x, y, direction):
-    super(Bullet, self).__init__(x, y, ["renderable", "updateable", "bullet"], 4, 3, "tiles.bmp")
+    super(Bullet, self).__init__(x, y, [], 4, 3, "tiles.bmp")
     self.speed = 8
-    self.groups.append(GameState.state)
+    self.reset(x, y, direction)
+
+  @staticmethod
+  def spare():
+    return Bullet(0, 0, DOWN)
+
+  def reset(self, x, y, direction):
+    self.x = x
+    self.y = y
+    self.flicker = 0
+    self.mask = Groups.mask(["renderable", "bullet", GameState.state])
 
     if direction == RIGHT: self.dx, self.dy = (1, 0)
     if direction == LEFT: self.dx, self.dy = (-1, 0)
@@ -747,19 +2204,22 @@ class Bullet(Entity):
     if direction == DOWN: self.dx, self.dy = (0, 1)
 
   def flip(self, entity):
-    if "future" in entity.groups:
-      entity.groups.remove("future")
-      entity.groups.append("present")
-    elif "present" in entity.groups:
-      entity.groups.remove("present")
-      entity.groups.append("future")
-
+    if entity.has("future"):
+      entity.remove_group("future")
+      entity.add_group("present")
+    elif entity.has("present"):
+      entity.remove_group("present")
+      entity.add_group("future")
+
+  # Only used without numpy, otherwise Entities.projectiles does all this
+  # for every bullet at once.
   def update(self, entities):
     destroy = False
     self.x += self.dx * self.speed
     self.y += self.dy * self.speed
+    self.moved()
 
-    flip_these = entities.get("flippable", GameState.state, lambda x: self.touches_rect(x))
+    flip_these = [x for x in entities.near(self, "flippable", GameState.state) if self.touches_rect(x)]
 
     if len(flip_these) > 0:
       for x in flip_these:
@@ -771,7 +2231,7 @@ class Bullet(Entity):
       destroy = True
 
     if destroy:
-      entities.remove(self)
+      entities.release(self)
 
 class GameState:
   initial = 0
@@ -800,7 +2260,14 @@ def sleep_sequence(entities):
 
 sleep_sequence.ticker = 0
 
-def main():
+def new_game():
+  """ Set up a fresh world. Resets all the global state too, so this can be
+  called more than once (the benchmarks do). """
+  GameState.current_state = GameState.initial
+  UpKeys.keysup = []
+  UpKeys.keysactive = []
+  sleep_sequence.ticker = 0
+
   manager = Entities()
 
   init(manager)
@@ -817,42 +2284,193 @@ def main():
     m.new_map(manager)
     manager.add(m)
 
-  pygame.display.init()
-  pygame.font.init()
-
-  if not DEBUG:
-    pygame.mixer.init(frequency=22050, size=-16, channels=2, buffer=1024)
-    # pygame.mixer.music.load('ludumherp.mp3')
-    # pygame.mixer.music.play(-1) #Infinite loop! HAHAH!
-
-  clock = pygame.time.Clock()
-  while True:
-    clock.tick(TICKS_PER_SEC)
-
-    if GameState.current_state == GameState.sleep_sequence:
-      sleep_sequence(manager)
-      continue
-
-    for event in pygame.event.get():
-      UpKeys.flush()
-      if event.type == pygame.QUIT:
-        pygame.quit()
-        sys.exit()
-      if event.type == pygame.KEYDOWN:
-        UpKeys.add_key(event.key)
-      if event.type == pygame.KEYUP:
-        UpKeys.release_key(event.key)
-    
-    for e in manager.get("updateable"):
-      e.update(manager)
-
+  return manager
+
+# One tick of the main loop, in phases, so tools can drive and time it.
+
+def handle_events(events):
+  for event in events:
+    UpKeys.flush()
+    if event.type == pygame.QUIT:
+      pygame.quit()
+      sys.exit()
+    if event.type == pygame.KEYDOWN:
+      UpKeys.add_key(event.key)
+      if event.key == OVERLAY_KEY:
+        Profiler.toggle_overlay()
+    if event.type == pygame.KEYUP:
+      UpKeys.release_key(event.key)
+
+def update_all(manager):
+  manager.update_all()
+
+def render(manager, alpha=0.0):
+  """ Draw the frame. Returns the rects that changed, or None if it's all
+  new. alpha is how far we are from the last tick to the next one. """
+  manager.alpha = alpha
+  screen = Profiler.counted(Display.get())
+  dirty = None
+
+  if DIRTY_RECTS:
+    if Profiler.overlay_gone(): # Draw what it was covering.
+      manager.drawn = None
+    dirty = manager.render_dirty(screen)
+  else:
     screen.fill((255, 255, 255))
-
     manager.render_all(screen)
-     
+
+  if Profiler.overlay:
+    covered = Profiler.draw_overlay(Display.get(), Fonts.get(*OVERLAY_FONT))
+    if dirty is not None:
+      dirty.append(covered)
+
+  return dirty
+
+def present(dirty):
+  if dirty is None:
     pygame.display.flip()
-    
+  else:
+    pygame.display.update(dirty)
+
+class Timestep:
+  """ Keeps game time going at TICKS_PER_SEC of real time, however long
+  frames take to draw. Real time piles up, and each time around the main
+  loop we run as many fixed length ticks as it's enough for, then draw once.
+  Drawing gets skipped while we're behind, so a slow frame costs frames
+  instead of game time. Only when the ticks themselves can't keep up does
+  game time slow down. """
+  def __init__(self, rate=TICKS_PER_SEC):
+    self.step = 1.0 / rate
+    self.last = default_timer()
+    self.piled = self.step # Real time the ticks haven't caught up with yet.
+    self.skipped = 0
+
+  def elapsed(self):
+    now = default_timer()
+    spent, self.last = now - self.last, now
+    return spent
+
+  def ticks(self):
+    """ Wait until the next tick is due, then say how many are. """
+    self.piled += self.elapsed()
+    if self.piled < self.step:
+      time.sleep(self.step - self.piled)
+      self.piled += self.elapsed()
+
+    due = int(self.piled / self.step)
+    if due > MAX_CATCH_UP: # Let the rest go.
+      due = MAX_CATCH_UP
+      self.piled = due * self.step
+
+    self.piled -= due * self.step
+    return due
+
+  def alpha(self):
+    return min(1.0, self.piled / self.step)
+
+  def should_render(self):
+    """ Whether to draw now, after the ticks: not if the next tick is due
+    already, unless that's been the case for too many frames in a row. """
+    behind = self.piled + default_timer() - self.last >= self.step
+    if behind and self.skipped < MAX_FRAME_SKIP:
+      self.skipped += 1
+      return False
 
-main()
-    
+    self.skipped = 0
+    return True
 
+def main(args=[]):
+  parser = argparse.ArgumentParser(description="Ludum Dare 22.")
+  parser.add_argument("--record", metavar="FILE", help="log all input to FILE")
+  parser.add_argument("--replay", metavar="FILE", help="play back input logged with --record")
+  parser.add_argument("--startup", action="store_true", help="say where the time to the first frame went, then quit")
+  parser.add_argument("--profile", action="store_true", help="start with the profiler's overlay up (F3 toggles it)")
+  parser.add_argument("--trace", metavar="FILE", help="profile every frame and save them to FILE as Chrome trace events")
+  options = parser.parse_args(args)
+
+  global DEBUG
+  recorder = playback = None
+
+  if options.replay:
+    playback = Replay(options.replay)
+    DEBUG = playback.debug
+  if options.record:
+    recorder = Recorder(options.record, DEBUG)
+  if options.profile:
+    Profiler.toggle_overlay()
+  if options.trace:
+    Profiler.start_trace()
+
+  with Startup.timing("world"):
+    manager = new_game()
+
+  # if not DEBUG:
+  #   Music.play('ludumherp.mp3') #Infinite loop! HAHAH!
+
+  timestep = Timestep()
+  tick = 0
+  first_frame = True
+  Startup.begin("first frame")
+
+  try:
+    while True:
+      due = timestep.ticks()
+      Profiler.start_frame()
+      polled = ran = False
+
+      for i in range(due):
+        if GameState.current_state == GameState.sleep_sequence:
+          sleep_sequence(manager)
+          continue
+
+        if playback is not None and playback.finished(tick):
+          return
+
+        # Replays have events for every tick, the window only gets asked
+        # once a frame.
+        events = [] if playback is None else playback.events(tick)
+        if not polled:
+          # Still let the window be closed during a replay.
+          events += pygame.event.get() if playback is None else pygame.event.get(pygame.QUIT)
+          polled = True
+
+        if recorder is not None:
+          recorder.record(events)
+
+        Profiler.begin("events")
+        handle_events(events)
+        Profiler.end()
+        Profiler.begin("update")
+        update_all(manager)
+        Profiler.end()
+        tick += 1
+        ran = True
+
+      # Sleep sequences leave the last frame up.
+      if ran and timestep.should_render():
+        Profiler.begin("render")
+        dirty = render(manager, timestep.alpha())
+        Profiler.end()
+        Profiler.begin("present")
+        present(dirty)
+        Profiler.end()
+
+        if first_frame:
+          first_frame = False
+          Startup.end()
+          if DEBUG or options.startup:
+            Startup.report()
+          if options.startup:
+            return
+
+      Profiler.end_frame()
+  finally:
+    if recorder is not None:
+      recorder.close()
+    if options.trace:
+      Profiler.save(options.trace)
+
+Startup.add("imports", default_timer() - started)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
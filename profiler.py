@@ -0,0 +1,261 @@
+""" Where a frame's time goes. Off unless something asks for it, and close to
+free while it's off: the game only checks Profiler.on, which gets looked at
+again at the start of each frame.
+
+While it's on, each frame records
+
+    phases   how long each named phase took (events, update, render and
+             present, plus anything that times itself, like new_map).
+             Nested phases count toward their parents too.
+    classes  update and render time for each entity class
+    counts   entity queries run and blits to the screen
+    memory   bytes allocated, if we have tracemalloc (Python 3, or 2.7 with
+             pytracemalloc). Otherwise it's just left out.
+
+The last frame can be drawn over the game (F3), and every frame can be
+saved as Chrome trace events, to look at in chrome://tracing or Perfetto:
+
+    python main.py --trace run.json
+"""
+
+import json
+from timeit import default_timer
+from contextlib import contextmanager
+
+try:
+  import tracemalloc
+except ImportError: # Allocations just don't get counted.
+  tracemalloc = None
+
+# How many entity classes the overlay lists for update and for render.
+OVERLAY_CLASSES = 4
+
+class Frame:
+  def __init__(self, number):
+    self.number = number
+    self.start = default_timer()
+    self.length = 0.0
+    self.phases = {}  # name => seconds
+    self.order = []   # Phase names, in the order they first started.
+    self.classes = {"update": {}, "render": {}} # kind => {class name => seconds}
+    self.counts = {"queries": 0, "blits": 0}
+    self.memory = None # (allocated this frame, in use), in bytes
+
+class Counted:
+  """ A stand in for the screen that counts what gets drawn on it. """
+  def __init__(self, surface):
+    self.surface = surface
+
+  def blit(self, *args):
+    Profiler.frame.counts["blits"] += 1
+    return self.surface.blit(*args)
+
+  def __getattr__(self, name):
+    return getattr(self.surface, name)
+
+class Profiler:
+  on = False
+  overlay = False
+  tracing = False
+
+  frames = 0
+  frame = None # The one being recorded.
+  last = None  # The last one done, which is what the overlay shows.
+
+  running = [] # [name, started]
+  overlay_shown = False
+
+  # Chrome trace events, and which process (one per trace) they go under.
+  events = []
+  pid = 0
+  epoch = default_timer()
+
+  @staticmethod
+  def toggle_overlay():
+    """ Takes effect next frame. """
+    Profiler.overlay = not Profiler.overlay
+
+  @staticmethod
+  def start_trace(name="ld22"):
+    """ Record every frame from the next one on, as a new process in the
+    trace. """
+    Profiler.tracing = True
+    Profiler.pid += 1
+    Profiler.events.append({"name": "process_name", "ph": "M", "pid": Profiler.pid, "tid": 1,
+                            "args": {"name": name}})
+
+  @staticmethod
+  def stop_trace():
+    Profiler.tracing = False
+
+  @staticmethod
+  def save(path):
+    out = open(path, "w")
+    json.dump({"traceEvents": Profiler.events, "displayTimeUnit": "ms"}, out)
+    out.close()
+
+  @staticmethod
+  def start_frame():
+    Profiler.on = Profiler.overlay or Profiler.tracing
+    if not Profiler.on:
+      Profiler.frame = None
+      return
+
+    if tracemalloc is not None and not tracemalloc.is_tracing():
+      tracemalloc.start()
+
+    Profiler.frames += 1
+    Profiler.frame = Frame(Profiler.frames)
+    Profiler.running = []
+    if tracemalloc is not None:
+      Profiler.frame.memory = tracemalloc.get_traced_memory()[0]
+
+  @staticmethod
+  def end_frame():
+    frame = Profiler.frame
+    if frame is None:
+      return
+
+    frame.length = default_timer() - frame.start
+    if tracemalloc is not None:
+      in_use = tracemalloc.get_traced_memory()[0]
+      frame.memory = (in_use - frame.memory, in_use)
+
+    if Profiler.tracing:
+      Profiler.trace_frame(frame)
+
+    Profiler.last = frame
+    Profiler.frame = None
+
+  @staticmethod
+  def begin(name):
+    if not Profiler.on:
+      return
+
+    frame = Profiler.frame
+    if frame is not None and name not in frame.phases:
+      frame.phases[name] = 0.0
+      frame.order.append(name)
+
+    Profiler.running.append([name, default_timer()])
+
+  @staticmethod
+  def end():
+    if not Profiler.on or not Profiler.running:
+      return
+
+    name, start = Profiler.running.pop()
+    spent = default_timer() - start
+
+    if Profiler.frame is not None:
+      Profiler.frame.phases[name] += spent
+
+    if Profiler.tracing:
+      Profiler.events.append(Profiler.event(name, "phase", start, spent))
+
+  @staticmethod
+  @contextmanager
+  def timing(name):
+    """ begin() and end(), for things that don't happen every frame. """
+    Profiler.begin(name)
+    try:
+      yield
+    finally:
+      Profiler.end()
+
+  @staticmethod
+  def count(what, n=1):
+    if Profiler.frame is not None:
+      Profiler.frame.counts[what] = Profiler.frame.counts.get(what, 0) + n
+
+  @staticmethod
+  def each(kind, entities, call):
+    """ call(e) for each of entities, timing it by e's class. """
+    if Profiler.frame is None:
+      for e in entities:
+        call(e)
+      return
+
+    spent = Profiler.frame.classes[kind]
+    for e in entities:
+      start = default_timer()
+      call(e)
+      name = type(e).__name__
+      spent[name] = spent.get(name, 0.0) + default_timer() - start
+
+  @staticmethod
+  def counted(screen):
+    """ screen, but blits to it get counted. """
+    if Profiler.frame is None:
+      return screen
+    return Counted(screen)
+
+  @staticmethod
+  def event(name, category, start, seconds, args=None):
+    event = {"name": name, "cat": category, "ph": "X", "pid": Profiler.pid, "tid": 1,
+             "ts": (start - Profiler.epoch) * 1e6, "dur": seconds * 1e6}
+    if args:
+      event["args"] = args
+    return event
+
+  @staticmethod
+  def trace_frame(frame):
+    """ The frame itself, with what each class took as its args, and the
+    counts as counters, so they get graphed. """
+    args = {}
+    for kind, spent in frame.classes.items():
+      for name, seconds in spent.items():
+        args["%s %s (ms)" % (kind, name)] = round(seconds * 1000, 3)
+
+    Profiler.events.append(Profiler.event("frame %d" % frame.number, "frame", frame.start, frame.length, args))
+
+    counters = dict(frame.counts)
+    if frame.memory is not None:
+      counters["allocated"] = frame.memory[0]
+    ts = (frame.start - Profiler.epoch) * 1e6
+    for name, value in counters.items():
+      Profiler.events.append({"name": name, "ph": "C", "pid": Profiler.pid, "tid": 1, "ts": ts,
+                              "args": {name: value}})
+
+  @staticmethod
+  def overlay_lines():
+    frame = Profiler.last
+    if frame is None:
+      return ["profiling from the next frame..."]
+
+    lines = ["frame %d: %.2fms" % (frame.number, frame.length * 1000)]
+    lines.append("  ".join("%s %.2f" % (name, frame.phases[name] * 1000) for name in frame.order))
+
+    counts = "queries %d  blits %d" % (frame.counts["queries"], frame.counts["blits"])
+    if frame.memory is not None:
+      counts += "  alloc %+.1fKB (%dKB)" % (frame.memory[0] / 1024.0, frame.memory[1] / 1024)
+    lines.append(counts)
+
+    for kind in ["update", "render"]:
+      spent = sorted(frame.classes[kind].items(), key=lambda item: -item[1])[:OVERLAY_CLASSES]
+      lines.append(kind + ": " + "  ".join("%s %.2f" % (name, seconds * 1000) for name, seconds in spent))
+
+    return lines
+
+  @staticmethod
+  def draw_overlay(screen, font):
+    """ Draw the last frame's numbers across the top of screen. Returns
+    where. """
+    lines = Profiler.overlay_lines()
+    height = font.get_linesize()
+
+    rect = screen.fill((0, 0, 0), (0, 0, screen.get_width(), height * len(lines) + 4))
+    for i, line in enumerate(lines):
+      screen.blit(font.render(line, False, (255, 255, 255)), (2, 2 + i * height))
+
+    Profiler.overlay_shown = True
+    return rect
+
+  @staticmethod
+  def overlay_gone():
+    """ Was the overlay up last time but not now? Whatever's under it needs
+    drawing again. """
+    gone = Profiler.overlay_shown and not Profiler.overlay
+    if gone:
+      Profiler.overlay_shown = False
+    return gone
@@ -0,0 +1,97 @@
+""" Records the events the game loop sees, tick by tick, and plays them back
+so a session can be re-run exactly, e.g. under a profiler or on another
+build.
+
+A log is a header followed by one record for each tick that had events:
+
+    header  "LD22KEYS", version (uint8), flags (uint8), ticks (uint32)
+    record  tick (uint32), number of events (uint16), then for each event
+            its kind (uint8) and key (uint32)
+
+Everything is little endian. Ticks count the loop iterations that handled
+events, so sleep sequences don't throw the numbering off.
+"""
+
+import struct
+import pygame
+
+MAGIC = "LD22KEYS"
+VERSION = 1
+
+HEADER = struct.Struct("<8sBBI")
+RECORD = struct.Struct("<IH")
+EVENT = struct.Struct("<BI")
+
+# Header flags.
+FLAG_DEBUG = 1
+
+# Event kinds. Events that aren't keys still count, since UpKeys flushes on
+# every event it's handed.
+OTHER, KEYDOWN, KEYUP = range(3)
+
+class ReplayException(Exception):
+  pass
+
+def event_kind(event):
+  if event.type == pygame.KEYDOWN: return KEYDOWN
+  if event.type == pygame.KEYUP: return KEYUP
+  return OTHER
+
+def make_event(kind, key):
+  if kind == KEYDOWN: return pygame.event.Event(pygame.KEYDOWN, key=key)
+  if kind == KEYUP: return pygame.event.Event(pygame.KEYUP, key=key)
+  return pygame.event.Event(pygame.USEREVENT)
+
+class Recorder:
+  def __init__(self, path, debug=False):
+    self.log = open(path, "wb")
+    self.flags = FLAG_DEBUG if debug else 0
+    self.ticks = 0
+
+    # The tick count gets filled in by close().
+    self.log.write(HEADER.pack(MAGIC, VERSION, self.flags, 0))
+
+  def record(self, events):
+    """ Log one tick's worth of events. Returns them, untouched. """
+    if events:
+      self.log.write(RECORD.pack(self.ticks, len(events)))
+      for event in events:
+        self.log.write(EVENT.pack(event_kind(event), getattr(event, "key", 0)))
+
+    self.ticks += 1
+    return events
+
+  def close(self):
+    self.log.seek(0)
+    self.log.write(HEADER.pack(MAGIC, VERSION, self.flags, self.ticks))
+    self.log.close()
+
+class Replay:
+  def __init__(self, path):
+    data = open(path, "rb").read()
+
+    if len(data) < HEADER.size:
+      raise ReplayException(path + " is too short to be a replay.")
+
+    magic, version, flags, self.ticks = HEADER.unpack_from(data)
+    if magic != MAGIC:
+      raise ReplayException(path + " is not a replay.")
+    if version != VERSION:
+      raise ReplayException("%s is replay version %d, we read %d." % (path, version, VERSION))
+
+    self.debug = bool(flags & FLAG_DEBUG)
+    self.log = {}
+
+    offset = HEADER.size
+    while offset < len(data):
+      tick, count = RECORD.unpack_from(data, offset)
+      offset += RECORD.size
+
+      self.log[tick] = [EVENT.unpack_from(data, offset + i * EVENT.size) for i in range(count)]
+      offset += count * EVENT.size
+
+  def finished(self, tick):
+    return tick >= self.ticks
+
+  def events(self, tick):
+    return [make_event(kind, key) for kind, key in self.log.get(tick, [])]
@@ -1,7 +1,11 @@
 import pygame
  
 class spritesheet(object):
-    def __init__(self, filename):
+    def __init__(self, filename, image = None):
+        if image is not None:
+            # Already loaded, e.g. out of the asset bundle
+            self.sheet = image.convert()
+            return
         try:
             self.sheet = pygame.image.load(filename).convert()
         except pygame.error, message:
@@ -18,6 +22,16 @@ class spritesheet(object):
                 colorkey = image.get_at((0,0))
             image.set_colorkey(colorkey, pygame.RLEACCEL)
         return image
+    # A view of a specific rectangle, sharing the sheet's pixels
+    def view_at(self, rectangle, colorkey = None):
+        "Like image_at, but copies nothing. Don't draw on it, that draws on the sheet"
+        image = self.sheet.subsurface(pygame.Rect(rectangle))
+        if colorkey is not None:
+            if colorkey is -1:
+                colorkey = image.get_at((0,0))
+            # No RLEACCEL: RLE would give the view its own copy of the pixels.
+            image.set_colorkey(colorkey)
+        return image
     # Load a whole bunch of images and return them as a list
     def images_at(self, rects, colorkey = None):
         "Loads multiple images, supply a list of coordinates" 
@@ -29,8 +29,12 @@ def render_textrect(string, font, rect, text_color, background_color, fuzzy=Fals
     Failure - raises a TextRectException if the text won't fit onto the surface.
     """
 
-    import pygame
-    
+    return render_lines(wrap_lines(string, font, rect.width), font, rect, text_color, background_color, fuzzy, justification)
+
+def wrap_lines(string, font, width):
+    """Splits string into the lines render_textrect would draw it as, in a
+    rect width wide. Raises a TextRectException if a word won't fit."""
+
     final_lines = []
 
     requested_lines = string.splitlines()
@@ -39,18 +43,18 @@ def render_textrect(string, font, rect, text_color, background_color, fuzzy=Fals
     # rectangle.
 
     for requested_line in requested_lines:
-        if font.size(requested_line)[0] > rect.width:
+        if font.size(requested_line)[0] > width:
             words = requested_line.split(' ')
             # if any of our words are too long to fit, return.
             for word in words:
-                if font.size(word)[0] >= rect.width:
+                if font.size(word)[0] >= width:
                     raise TextRectException, "The word " + word + " is too long to fit in the rect passed."
             # Start a new line
             accumulated_line = ""
             for word in words:
                 test_line = accumulated_line + word + " "
                 # Build the line while the words fit.    
-                if font.size(test_line)[0] < rect.width:
+                if font.size(test_line)[0] < width:
                     accumulated_line = test_line 
                 else: 
                     final_lines.append(accumulated_line) 
@@ -59,6 +63,14 @@ def render_textrect(string, font, rect, text_color, background_color, fuzzy=Fals
         else: 
             final_lines.append(requested_line) 
 
+    return final_lines
+
+def render_lines(final_lines, font, rect, text_color, background_color, fuzzy=False, justification=0):
+    """Like render_textrect, but for text that's already been split up with
+    wrap_lines."""
+
+    import pygame
+
     # Let's try to write the text out on the surface.
 
     surface = pygame.Surface(rect.size) 